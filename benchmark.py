@@ -0,0 +1,606 @@
+"""Бенчмарки бота.
+
+Запуск:
+    python benchmark.py db [--updates 5000] [--concurrency 100]
+    python benchmark.py session [--requests 2000] [--concurrency 100] [--api-latency 0.02]
+    python benchmark.py webhook [--users 1000] [--rate 500] [--concurrency 100]
+    python benchmark.py broadcast [--users 100000] [--broadcast-workers 64]
+    python benchmark.py inbound [--users 1000] [--irrelevant 0.25]
+
+Сценарии webhook и broadcast работают с fake_bot_api.py вместо Telegram.
+Лимиты Telegram по умолчанию сняты (--send-rate, --chat-rate), чтобы мерить
+сам бот, а не очередь отправки.
+
+С --output результат сохраняется в JSON вместе с коммитом и параметрами,
+--compare печатает разницу с ранее сохранённым результатом.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+# Бенчмарк работает с временной БД, а не с livegram.db, и не ставит вебхук
+_TMP_DIR = tempfile.mkdtemp(prefix="livegram-bench-")
+os.environ.setdefault("DB_PATH", os.path.join(_TMP_DIR, "bench.db"))
+os.environ.setdefault("RENDER_EXTERNAL_HOSTNAME", "")
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import bot  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from fake_bot_api import FakeBotAPI, start_server  # noqa: E402
+
+
+# --- ================================== ---
+# ---    БЕНЧМАРК: СЛОЙ БАЗЫ ДАННЫХ      ---
+# --- ================================== ---
+
+# Старая реализация: новое соединение и синхронные запросы прямо в event loop
+async def legacy_db_add_user(path: str, user_id: int):
+    with sqlite3.connect(path) as db:
+        cursor = db.cursor()
+        cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+        cursor.execute("UPDATE users SET is_blocked_bot = 0 WHERE user_id = ?", (user_id,))
+        db.commit()
+
+async def legacy_db_is_user_banned(path: str, user_id: int) -> bool:
+    with sqlite3.connect(path) as db:
+        cursor = db.cursor()
+        cursor.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id,))
+        result = cursor.fetchone()
+        return result[0] == 1 if result else False
+
+
+async def _run_updates(handle, updates: int, concurrency: int, network_delay: float, finish=None) -> float:
+    """Прогоняет updates обновлений через handle и возвращает обновлений/сек.
+
+    finish - корутина, которая входит в замер (например, сброс отложенных записей).
+    """
+    queue = iter(range(updates))
+
+    async def worker():
+        for i in queue:
+            await handle(1_000_000 + i)
+            # Имитация запроса к Bot API, который в реальном боте идёт после БД
+            await asyncio.sleep(network_delay)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    if finish is not None:
+        await finish()
+    return updates / (time.perf_counter() - started)
+
+
+async def bench_db(args) -> dict:
+    legacy_path = os.path.join(_TMP_DIR, "legacy.db")
+    with sqlite3.connect(legacy_path) as db:
+        bot._db_init_sync(db)
+
+    async def legacy_update(user_id):
+        await legacy_db_add_user(legacy_path, user_id)
+        await legacy_db_is_user_banned(legacy_path, user_id)
+
+    async def storage_update(user_id):
+        await bot.db_add_user(user_id)
+        await bot.db_is_user_banned(user_id)
+
+    await bot.db_init()
+    before = await _run_updates(legacy_update, args.updates, args.concurrency, args.network_delay)
+    bot.user_journal.start()
+    after = await _run_updates(storage_update, args.updates, args.concurrency, args.network_delay,
+                               finish=bot.user_journal.stop)
+    await bot.storage.close()
+    return {"before_updates_per_sec": round(before, 1), "after_updates_per_sec": round(after, 1)}
+
+
+# --- ================================== ---
+# ---    БЕНЧМАРК: HTTP-СЕССИЯ BOT API    ---
+# --- ================================== ---
+
+async def _send_many(session, requests: int, concurrency: int) -> float:
+    """Отправляет requests сообщений через session и возвращает запросов/сек."""
+    client = Bot(token=bot.API_TOKEN, session=session)
+    queue = iter(range(requests))
+
+    async def worker():
+        for i in queue:
+            await client.send_message(1_000_000 + i, "bench")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    await session.close()
+    return requests / elapsed
+
+
+async def bench_session(args) -> dict:
+    api = FakeBotAPI(latency=args.api_latency)
+    runner, url = await start_server(api)
+    variants = {
+        # Без keep-alive: новое TCP-соединение на каждый запрос
+        "no_keepalive": lambda: bot.make_session(keepalive=None, api_url=url),
+        "pool_10": lambda: bot.make_session(pool_size=10, api_url=url),
+        f"pool_{bot.HTTP_POOL_SIZE}": lambda: bot.make_session(api_url=url),
+    }
+    result = {}
+    try:
+        for name, make in variants.items():
+            rate = await _send_many(make(), args.requests, args.concurrency)
+            result[f"{name}_requests_per_sec"] = round(rate, 1)
+    finally:
+        await runner.cleanup()
+    return result
+
+
+# --- ================================== ---
+# ---   БЕНЧМАРК: ВЕБХУК И РАССЫЛКИ      ---
+# --- ================================== ---
+
+USER_ID_BASE = 1_000_000
+ADMIN_ID_BASE = 900_000
+
+
+class UpdateFactory:
+    """Сырые обновления Telegram в том виде, в каком их присылает вебхук."""
+
+    def __init__(self):
+        self.message_id = 0
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def _message(self, user_id: int, text: str, **extra) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+            **extra,
+        }
+
+    def message(self, user_id: int, text: str) -> dict:
+        return {"message": self._message(user_id, text)}
+
+    def reply(self, admin_id: int, text: str) -> dict:
+        # Ответ админа на пересланный ботом вопрос. Какой message_id получила
+        # копия, известно только после пересылки - его подставляет link_reply
+        original = self._message(admin_id, "Вопрос")
+        return {"message": self._message(admin_id, text, reply_to_message=original)}
+
+    def edited(self, user_id: int, text: str) -> dict:
+        return {"edited_message": self._message(user_id, text, edit_date=int(time.time()))}
+
+    def channel_post(self, channel_id: int, text: str) -> dict:
+        self.message_id += 1
+        return {"channel_post": {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": channel_id, "type": "channel", "title": "Канал"},
+            "sender_chat": {"id": channel_id, "type": "channel", "title": "Канал"},
+            "text": text,
+        }}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {"callback_query": {
+            "id": str(self.message_id),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "message": self._message(user_id, "Выберите, кому вы хотите задать вопрос:"),
+            "data": data,
+        }}
+
+
+def synthetic_updates(users: int, admins: list[int], messages_per_user: int,
+                      first_user: int = USER_ID_BASE, first_update_id: int = 1,
+                      replies: dict | None = None) -> list[dict]:
+    """Диалоги пользователей (старт, выбор админа, вопросы, ответ админа).
+
+    Диалоги перемешаны между собой, но порядок внутри диалога сохраняется.
+    В replies (если передан) пишется update_id ответа админа -> user_id.
+    """
+    factory = UpdateFactory()
+    flows, reply_users = [], {}
+    for n in range(users):
+        user_id = first_user + n
+        admin_id = admins[n % len(admins)]
+        flow = [
+            factory.message(user_id, "/start"),
+            factory.message(user_id, "Выбор админа"),
+            factory.callback(user_id, f"select_admin_{admin_id}"),
+        ]
+        flow += [factory.message(user_id, f"Вопрос {i}") for i in range(messages_per_user)]
+        reply = factory.reply(admin_id, "Ответ")
+        reply_users[id(reply)] = user_id
+        flow.append(reply)
+        flows.append(flow)
+    updates = []
+    for step in range(max(map(len, flows), default=0)):
+        updates += [flow[step] for flow in flows if step < len(flow)]
+    for update_id, update in enumerate(updates, first_update_id):
+        update["update_id"] = update_id
+        if replies is not None and id(update) in reply_users:
+            replies[update_id] = reply_users[id(update)]
+    return updates
+
+
+def _percentiles(values: list[float], prefix: str) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        f"{prefix}_p{p}_ms": round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 2)
+        for p in (50, 95, 99)
+    }
+
+
+async def _start_fake_api(args) -> tuple[FakeBotAPI, web.AppRunner]:
+    """Поднимает fake_bot_api и направляет на него бота."""
+    api = FakeBotAPI(latency=args.api_latency, blocked_rate=args.blocked_rate)
+    runner, url = await start_server(api)
+    bot.bot.session.api = TelegramAPIServer.from_base(url)
+    bot.outbound.bucket = bot.TokenBucket(args.send_rate)
+    bot.outbound.chat_rate = args.chat_rate
+    bot.outbound.chat_burst = max(bot.outbound.chat_burst, args.chat_rate)
+    return api, runner
+
+
+async def bench_webhook(args) -> dict:
+    api, api_runner = await _start_fake_api(args)
+    admins = [ADMIN_ID_BASE + i for i in range(args.admins)]
+    await bot.db_init()
+    for admin_id in admins:
+        await bot.db_add_admin(admin_id, f"Админ {admin_id}")
+    # Прогрев: aiogram лениво строит модели pydantic при первом использовании типа
+    replies = {}
+    warmup = synthetic_updates(1, admins, args.messages_per_user, first_user=USER_ID_BASE - 1, replies=replies)
+    updates = synthetic_updates(args.users or 1000, admins, args.messages_per_user,
+                                first_update_id=len(warmup) + 1, replies=replies)
+    linked = 0
+
+    async def link_reply(update):
+        """Ответ админа - на копию, которую бот действительно ему переслал.
+
+        Так ответ находит пользователя через message_links, как в жизни.
+        Копии может ещё не быть (обработка идёт после подтверждения) - ждём.
+        """
+        nonlocal linked
+        user_id = replies.get(update["update_id"])
+        if user_id is None:
+            return
+        message = update["message"]
+        key = (message["chat"]["id"], user_id)
+        deadline = time.perf_counter() + args.drain_timeout
+        while key not in api.copies and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        if key in api.copies:
+            message["reply_to_message"]["message_id"] = api.copies[key]
+            linked += 1
+
+    # Время окончания обработки каждого обновления
+    sent_at, done_at = {}, {}
+
+    async def record_done(handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            done_at[event.update_id] = time.perf_counter()
+
+    bot.dp.update.outer_middleware(record_done)
+
+    # Пересылка админу идёт после обработки, в его очереди - её время отдельно
+    update_of = {(u["message"]["chat"]["id"], u["message"]["message_id"]): u["update_id"]
+                 for u in warmup + updates if "message" in u}
+    relayed_at = {}
+    relay = bot.admin_relay._relay
+
+    async def record_relayed(admin_id, message):
+        try:
+            return await relay(admin_id, message)
+        finally:
+            relayed_at[update_of.get((message.chat.id, message.message_id))] = time.perf_counter()
+
+    bot.admin_relay._relay = record_relayed
+
+    app = web.Application()
+    app.router.add_post(bot.WEBHOOK_PATH, bot.webhook_handler)
+    app.on_startup.append(lambda app: bot.on_startup(bot.dp, bot.bot))
+    app.on_shutdown.append(lambda app: bot.on_shutdown(bot.dp, bot.bot))
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{runner.addresses[0][1]}{bot.WEBHOOK_PATH}"
+    async with aiohttp.ClientSession() as client:
+        for update in warmup:
+            await link_reply(update)
+            async with client.post(url, json=update) as response:
+                await response.read()
+    while len(done_at) < len(warmup):
+        await asyncio.sleep(0.05)
+    done_at.clear()
+    relayed_at.clear()
+    linked = 0
+
+    ack_latency, errors = [], 0
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def post(client, update):
+        nonlocal errors
+        await link_reply(update)
+        async with limit:
+            started = sent_at[update["update_id"]] = time.perf_counter()
+            async with client.post(url, json=update) as response:
+                await response.read()
+                ack_latency.append(time.perf_counter() - started)
+                errors += response.status != 200
+
+    interval = 1 / args.rate if args.rate else 0
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as client:
+        tasks = []
+        for i, update in enumerate(updates):
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(client, update)))
+        await asyncio.gather(*tasks)
+    deadline = time.perf_counter() + args.drain_timeout
+    while len(done_at) < len(updates) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    finished = max(done_at.values(), default=time.perf_counter())
+
+    await runner.cleanup()
+    bot.admin_relay._relay = relay
+    await api_runner.cleanup()
+    return {
+        "updates": len(updates),
+        "processed": len(done_at),
+        "http_errors": errors,
+        "throughput_updates_per_sec": round(len(done_at) / (finished - started), 1),
+        **_percentiles(ack_latency, "ack"),
+        **_percentiles([done_at[i] - sent_at[i] for i in done_at if i in sent_at], "e2e"),
+        # От отправки обновления до копии в чате админа
+        **_percentiles([relayed_at[i] - sent_at[i] for i in relayed_at if i in sent_at], "relay"),
+        "api_calls": sum(api.calls.values()),
+        # Ответы админов, нашедшие пользователя через message_links
+        "admin_replies_linked": linked,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def with_irrelevant(updates: list[dict], share: float) -> list[dict]:
+    """Подмешивает обновления без хэндлеров (правки, посты каналов), как без allowed_updates.
+
+    share - их доля в итоговом потоке; update_id перенумеровываются по порядку.
+    """
+    factory = UpdateFactory()
+    extra = int(len(updates) * share / (1 - share)) if share < 1 else 0
+    result = list(updates)
+    for n in range(extra):
+        update = factory.edited(USER_ID_BASE + n, "правка") if n % 2 else factory.channel_post(-100 - n, "пост")
+        result.insert(round((n + 1) * len(result) / (extra + 1)), update)
+    first = updates[0]["update_id"] if updates else 1
+    for update_id, update in enumerate(result, first):
+        update["update_id"] = update_id
+    return result
+
+
+class _RawRequest:
+    """Ровно то, что webhook_handler берёт из запроса aiohttp, без HTTP."""
+
+    def __init__(self, body: bytes):
+        self._body = body
+        self.content_length = len(body)
+
+    async def read(self) -> bytes:
+        return self._body
+
+
+async def _feed_by_chat(handle, bodies: list[bytes], updates: list[dict], lanes: int):
+    """Обрабатывает тела параллельно, сохраняя порядок внутри чата (как UpdateQueue)."""
+    queues = [[] for _ in range(lanes)]
+    for body, update in zip(bodies, updates):
+        queues[bot.update_chat_id(update) % lanes].append(body)
+
+    async def lane(queue):
+        for body in queue:
+            await handle(body)
+
+    await asyncio.gather(*(lane(queue) for queue in queues))
+
+
+async def bench_inbound(args) -> dict:
+    """CPU на обновление: прежний путь (request.json() и диспетчер для всего)
+    против текущего webhook_handler (быстрый JSON, отсев до валидации)."""
+    api, api_runner = await _start_fake_api(args)
+    admins = [ADMIN_ID_BASE + i for i in range(args.admins)]
+    await bot.db_init()
+    for admin_id in admins:
+        await bot.db_add_admin(admin_id, f"Админ {admin_id}")
+    bot.inbound_filter.configure(bot.dp.resolve_used_update_types())
+    users = args.users or 1000
+
+    async def legacy(body: bytes):
+        await bot.dp.feed_raw_update(bot.bot, json.loads(body))
+
+    async def current(body: bytes):
+        await bot.webhook_handler(_RawRequest(body))
+
+    # Разные пользователи на каждый проход: состояние БД у проходов одинаковое
+    passes = {}
+    first_update_id = 1
+    for name, first_user in (("warmup", USER_ID_BASE - 10), ("legacy", USER_ID_BASE),
+                             ("current", USER_ID_BASE + users)):
+        count = 2 if name == "warmup" else users
+        updates = with_irrelevant(
+            synthetic_updates(count, admins, args.messages_per_user, first_user, first_update_id), args.irrelevant
+        )
+        first_update_id += len(updates)
+        passes[name] = (updates, [json.dumps(update, ensure_ascii=False).encode() for update in updates])
+
+    warm_updates, warm_bodies = passes.pop("warmup")
+    half = len(warm_bodies) // 2
+    await _feed_by_chat(legacy, warm_bodies[:half], warm_updates[:half], 1)
+    await _feed_by_chat(current, warm_bodies[half:], warm_updates[half:], 1)
+
+    result = {"updates": len(passes["current"][0]), "irrelevant_share": args.irrelevant,
+              "decoder": "orjson" if bot.orjson else "json"}
+    for name, handle in (("legacy", legacy), ("current", current)):
+        updates, bodies = passes[name]
+        cpu, wall = time.process_time(), time.perf_counter()
+        await _feed_by_chat(handle, bodies, updates, args.concurrency)
+        await bot.outbound.stop()
+        result[f"cpu_us_per_update_{name}"] = round((time.process_time() - cpu) / len(bodies) * 1e6, 1)
+        result[f"wall_seconds_{name}"] = round(time.perf_counter() - wall, 2)
+    result["cpu_change"] = f"{result['cpu_us_per_update_current'] / result['cpu_us_per_update_legacy'] - 1:+.1%}"
+
+    # Отдельно обновления без хэндлеров: на них и приходится выигрыш от отсева
+    bodies = [body for update, body in zip(*passes["current"]) if "message" not in update
+              and "callback_query" not in update]
+    for name, handle in (("legacy", legacy), ("current", current)):
+        started = time.process_time()
+        for body in bodies:
+            await handle(body)
+        result[f"cpu_us_per_irrelevant_{name}"] = round((time.process_time() - started) / len(bodies) * 1e6, 1)
+
+    # Только разбор JSON
+    bodies = passes["current"][1]
+    for name, loads in (("json", json.loads), ("fast", bot.inbound_filter.loads)):
+        started = time.process_time()
+        for body in bodies:
+            loads(body)
+        result[f"decode_us_{name}"] = round((time.process_time() - started) / len(bodies) * 1e6, 2)
+
+    await bot.storage.close()
+    await bot.bot.session.close()
+    await api_runner.cleanup()
+    return result
+
+
+async def bench_broadcast(args) -> dict:
+    api, api_runner = await _start_fake_api(args)
+    users = args.users or 100_000
+    await bot.db_init()
+    now = time.time()
+    for start in range(0, users, 10_000):
+        await bot.storage.executemany(
+            bot.SQL_ADD_USER,
+            [(USER_ID_BASE + n, now) for n in range(start, min(users, start + 10_000))],
+            op="bench_seed_users"
+        )
+    bot.user_journal.start()
+    bot.broadcaster.workers = args.broadcast_workers
+
+    started = time.perf_counter()
+    job = await bot.broadcaster.create(ADMIN_ID_BASE, bot.Audience(), text="bench")
+    while job.job_id in bot.broadcaster.jobs:
+        await asyncio.sleep(0.1)
+    elapsed = time.perf_counter() - started
+
+    await bot.user_journal.stop()
+    await bot.outbound.stop()
+    await bot.storage.close()
+    await bot.bot.session.close()
+    await api_runner.cleanup()
+    return {
+        "users": users,
+        "status": job.status,
+        "sent": job.sent,
+        "blocked": job.blocked,
+        "failed": job.failed,
+        "seconds": round(elapsed, 2),
+        "messages_per_sec": round(job.done / elapsed, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+SCENARIOS = {
+    "db": bench_db,
+    "session": bench_session,
+    "webhook": bench_webhook,
+    "broadcast": bench_broadcast,
+    "inbound": bench_inbound,
+}
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(result: dict, path: str):
+    with open(path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nСравнение с {path} (коммит {baseline.get('commit')}):")
+    for key, value in result.items():
+        old = baseline["result"].get(key)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            print(f"{key}: {old} -> {value} ({(value - old) / old:+.1%})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--network-delay", type=float, default=0.002,
+                        help="имитация задержки Bot API на обновление, сек")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--api-latency", type=float, default=0.02,
+                        help="задержка ответа fake_bot_api, сек")
+    parser.add_argument("--blocked-rate", type=float, default=0.0,
+                        help="доля ответов fake_bot_api 'бот заблокирован'")
+    parser.add_argument("--users", type=int, default=None,
+                        help="число пользователей (webhook: 1000, broadcast: 100000)")
+    parser.add_argument("--admins", type=int, default=5)
+    parser.add_argument("--messages-per-user", type=int, default=3)
+    parser.add_argument("--rate", type=float, default=0,
+                        help="обновлений в секунду, 0 - без ограничения")
+    parser.add_argument("--drain-timeout", type=float, default=60,
+                        help="сколько ждать обработки после отправки последнего обновления, сек")
+    parser.add_argument("--broadcast-workers", type=int, default=64)
+    parser.add_argument("--irrelevant", type=float, default=0.25,
+                        help="inbound: доля обновлений без хэндлеров (правки, посты каналов)")
+    parser.add_argument("--send-rate", type=float, default=100_000, help="общий лимит отправки, в секунду")
+    parser.add_argument("--chat-rate", type=float, default=100_000, help="лимит отправки в один чат, в секунду")
+    parser.add_argument("--output", help="сохранить результат в JSON")
+    parser.add_argument("--compare", help="сравнить с результатом из JSON")
+    args = parser.parse_args(argv)
+
+    # Логи каждого обновления искажают замеры
+    logging.getLogger().setLevel(logging.WARNING)
+    result = asyncio.run(SCENARIOS[args.scenario](args))
+    for key, value in result.items():
+        print(f"{key}: {value}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "scenario": args.scenario,
+                "commit": _git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "args": vars(args),
+                "result": result,
+            }, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        _compare(result, args.compare)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,164 +3,3040 @@ import logging
 import sys
 import re
 import sqlite3
+import json
 import os
-from aiohttp import web
+import time
+import signal
+import ssl
+import multiprocessing
+import heapq
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone, tzinfo
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from concurrent.futures import ThreadPoolExecutor
+import certifi
+from aiohttp import ClientSession, TCPConnector, web
 
-from aiogram import Bot, Dispatcher, F, types
-from aiogram.filters import CommandStart, Command
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, types
+from aiogram.filters import CommandStart, Command, and_f, or_f
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardButton,
-    ReplyKeyboardMarkup, KeyboardButton, Update
+    ReplyKeyboardMarkup, KeyboardButton, Update, InlineKeyboardMarkup, BufferedInputFile,
+    FSInputFile, InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 )
+from aiogram.dispatcher.event.bases import SkipHandler
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramForbiddenError
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+
+try:
+    # Необязательная зависимость: разбирает JSON обновлений в разы быстрее json
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # --- ================================== ---
 # --- ⚙️ БЛОК: КОНФИГУРАЦИЯ И WEBHOOK ⚙️ ---
 # --- ================================== ---
 
-# Ваш токен
-API_TOKEN = '8394122518:AAGwqm3gujAyAQH00WFeP1vqh8AMaTqbKL0' 
+# Ваш токен
+API_TOKEN = '8394122518:AAGwqm3gujAyAQH00WFeP1vqh8AMaTqbKL0' 
+
+# 1. URL вашего хостинга (ТОЛЬКО ДОМЕН)
+# Используем адрес Render. Если домен изменится, замените "snowbot-o88c.onrender.com"
+RENDER_DOMAIN = "snowbot-o88c.onrender.com" 
+WEBHOOK_HOST = os.environ.get("RENDER_EXTERNAL_HOSTNAME", RENDER_DOMAIN) 
+
+# 2. URL, по которому Telegram будет отправлять обновления
+WEBHOOK_PATH = f'/webhook/{API_TOKEN}' 
+# 3. Полный URL для установки вебхука
+WEBHOOK_URL = f"https://{WEBHOOK_HOST}{WEBHOOK_PATH}" 
+# 4. Порт, который будет слушать веб-сервер (Render дает его через переменную PORT)
+WEB_SERVER_PORT = int(os.environ.get("PORT", 8080))
+
+# 5. Впишите сюда ID всех владельцев
+BOT_OWNERS = {
+    123456789: "Основной Владелец",  # <--- ЗАМЕНИТЕ ЭТОТ ID
+    987654321: "Второстепенный Программист" # <--- ЗАМЕНИТЕ ЭТОТ ID
+}
+
+# 6. Путь к файлу базы данных SQLite
+DB_PATH = os.environ.get("DB_PATH", "livegram.db")
+
+# 7. Исходящие сообщения: общий лимит в секунду (Bot API допускает около 30
+# сообщений в секунду в разные чаты) и лимит на один чат (около 1 в секунду,
+# короткие всплески допустимы). Рассылки: число параллельных отправителей
+SEND_RATE = float(os.environ.get("SEND_RATE", 25))
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", 1))
+SEND_CHAT_BURST = float(os.environ.get("SEND_CHAT_BURST", 3))
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", 8))
+
+# 8. Быстрый ответ на вебхук: обновления ставятся в очередь и обрабатываются
+# пулом воркеров (обновления одного чата - строго по порядку)
+WEBHOOK_FAST_ACK = os.environ.get("WEBHOOK_FAST_ACK", "1") == "1"
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 16))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+
+# 9. Отложенная запись состояния пользователей: как часто (сек) и после
+# скольких изменений сбрасывать накопленное в БД
+USER_JOURNAL_INTERVAL = float(os.environ.get("USER_JOURNAL_INTERVAL", 0.2))
+USER_JOURNAL_MAX_ENTRIES = int(os.environ.get("USER_JOURNAL_MAX_ENTRIES", 500))
+
+# 10. Диалоги пользователей с админами: время жизни без активности (сек)
+# и размер кэша в памяти
+CONVERSATION_TTL = float(os.environ.get("CONVERSATION_TTL", 7 * 24 * 3600))
+CONVERSATION_CACHE_SIZE = int(os.environ.get("CONVERSATION_CACHE_SIZE", 100_000))
+
+# 11. Связи "сообщение в чате админа -> пользователь" для ответов:
+# сколько хранить (сек) и сколько держать в памяти
+MESSAGE_LINK_TTL = float(os.environ.get("MESSAGE_LINK_TTL", 30 * 24 * 3600))
+MESSAGE_LINK_CACHE_SIZE = int(os.environ.get("MESSAGE_LINK_CACHE_SIZE", 50_000))
+
+# 12. Число процессов бота на одном порту (SO_REUSEPORT). Общее состояние
+# хранится в SQLite, процессы оповещают друг друга об изменениях через change_log
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", 1))
+MULTIPROCESS = WEB_WORKERS > 1
+# Сколько последних update_id помнить, чтобы не обработать повтор от Telegram
+UPDATE_DEDUP_SIZE = int(os.environ.get("UPDATE_DEDUP_SIZE", 10_000))
+
+# Номер текущего процесса. Действия "в одном экземпляре" (установка вебхука,
+# возобновление рассылок, очистка таблиц) выполняет процесс 0
+WORKER_ID = 0
+# Идентификатор запуска (общий для всех процессов одного запуска)
+RUN_ID = f"{os.getpid()}-{int(time.time())}"
+
+# 13. HTTP-сессия к Bot API: размер пула соединений, сколько (сек) держать
+# простаивающее соединение открытым и таймаут одного запроса. BOT_API_URL
+# позволяет направить бота на другой сервер, например на fake_bot_api.py
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 100))
+HTTP_KEEPALIVE = float(os.environ.get("HTTP_KEEPALIVE", 60))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+BOT_API_URL = os.environ.get("BOT_API_URL")
+
+# 14. Обновления, обработка которых заняла больше стольких секунд, пишутся в
+# лог с разбивкой по этапам (хэндлер, SQLite, запросы к Bot API)
+SLOW_UPDATE_THRESHOLD = float(os.environ.get("SLOW_UPDATE_THRESHOLD", 0.5))
+
+# 15. Защита от флуда: сколько сообщений в секунду в среднем разрешено одному
+# пользователю, сколько можно отправить подряд и на сколько секунд замьютить
+# нарушителя
+FLOOD_RATE = float(os.environ.get("FLOOD_RATE", 1))
+FLOOD_BURST = int(os.environ.get("FLOOD_BURST", 5))
+FLOOD_MUTE = float(os.environ.get("FLOOD_MUTE", 30))
+
+# 16. Архив переписки: как часто (сек) и после скольких сообщений
+# накопленное пишется в БД
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", 1))
+ARCHIVE_MAX_PENDING = int(os.environ.get("ARCHIVE_MAX_PENDING", 500))
+
+# 17. Кнопка "Любой свободный админ": пользователь попадает к админу с
+# наименьшей нагрузкой (открытые диалоги и сообщения за последний час)
+AUTO_ASSIGN = os.environ.get("AUTO_ASSIGN", "1") == "1"
+
+# 18. Обслуживание БД (чекпоинт WAL, ANALYZE, очистка свободных страниц):
+# как часто (сек) проверять, и сколько обновлений за это время ещё считается
+# затишьем, когда обслуживание не помешает пользователям
+DB_MAINTENANCE_INTERVAL = float(os.environ.get("DB_MAINTENANCE_INTERVAL", 60))
+DB_MAINTENANCE_QUIET = int(os.environ.get("DB_MAINTENANCE_QUIET", 30))
+
+# 19. Папка с файлами для рассылки командой /broadcast_file (путь к файлу
+# указывается относительно неё)
+BROADCAST_FILES_DIR = os.environ.get("BROADCAST_FILES_DIR", "broadcast_files")
+
+# 20. Максимальный размер тела запроса вебхука, байт. Обновления Telegram
+# на порядки меньше, большее тело отклоняется, не дойдя до разбора JSON
+MAX_UPDATE_SIZE = int(os.environ.get("MAX_UPDATE_SIZE", 256 * 1024))
+
+# 21. Часовой пояс времени в командах рассылки (at=18:00) и в ответах о них:
+# смещение (+03:00) или имя пояса (Europe/Moscow). Сервер на Render живёт по
+# UTC, поэтому по умолчанию UTC
+BROADCAST_TZ = os.environ.get("BROADCAST_TZ", "UTC")
+
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+
+
+class PooledSession(AiohttpSession):
+    """Сессия aiogram со своим пулом соединений.
+
+    AiohttpSession принимает только общий лимит соединений, а остальные
+    параметры TCPConnector держит во внутреннем поле. Чтобы не зависеть от
+    него, соединитель создаётся здесь: aiogram получает HTTP-сессию только
+    через create_session() и закрывает её через close().
+    """
+
+    def __init__(self, connector: dict, **kwargs):
+        super().__init__(**kwargs)
+        self.connector = connector
+        self._client: ClientSession | None = None
+
+    async def create_session(self) -> ClientSession:
+        if self._client is None or self._client.closed:
+            self._client = ClientSession(connector=TCPConnector(
+                ssl=ssl.create_default_context(cafile=certifi.where()), **self.connector
+            ))
+        return self._client
+
+    async def close(self):
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+            # Даём SSL-соединениям закрыться (как в AiohttpSession.close)
+            await asyncio.sleep(0.25)
+
+
+def make_session(pool_size: int = HTTP_POOL_SIZE, keepalive: float | None = HTTP_KEEPALIVE,
+                 timeout: float = HTTP_TIMEOUT, api_url: str | None = BOT_API_URL) -> AiohttpSession:
+    """HTTP-сессия к Bot API с пулом постоянных соединений.
+
+    keepalive=None - без keep-alive: новое соединение на каждый запрос.
+    """
+    api = TelegramAPIServer.from_base(api_url) if api_url else PRODUCTION
+    # Соединения переиспользуются между запросами, DNS кэшируется на 5 минут
+    connector = {"limit": pool_size, "limit_per_host": pool_size, "ttl_dns_cache": 300}
+    if keepalive is None:
+        connector["force_close"] = True
+    else:
+        connector["keepalive_timeout"] = keepalive
+    return PooledSession(connector, api=api, timeout=timeout)
+
+
+# Инициализация бота и диспетчера
+bot = Bot(token=API_TOKEN, session=make_session())
+dp = Dispatcher()
+USER_ID_PATTERN = re.compile(r"\(ID: (\d+)\)")
+
+
+# --- ================================== ---
+# ---         БЛОК: МЕТРИКИ              ---
+# --- ================================== ---
+
+class Histogram:
+    """Гистограмма Prometheus: счётчики по корзинам, сумма и число наблюдений."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Метрики процесса в текстовом формате Prometheus (/metrics).
+
+    Запись - это поиск в словаре и сложение, без блокировок и аллокаций
+    сверх ключа меток, поэтому её можно делать на каждом обновлении.
+    Значения gauge вычисляются только в момент запроса /metrics.
+    """
+
+    def __init__(self):
+        # имя -> (тип, описание, {метки: значение})
+        self._families: dict[str, tuple[str, str, dict]] = {}
+        self._gauges: dict[str, tuple[str, object]] = {}
+
+    def counter(self, name: str, help_text: str):
+        self._families[name] = ("counter", help_text, {})
+
+    def histogram(self, name: str, help_text: str):
+        self._families[name] = ("histogram", help_text, {})
+
+    def gauge(self, name: str, help_text: str, func):
+        """func() возвращает число или список пар (метки, число)."""
+        self._gauges[name] = (help_text, func)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        samples = self._families[name][2]
+        key = tuple(labels.items())
+        samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        samples = self._families[name][2]
+        key = tuple(labels.items())
+        histogram = samples.get(key)
+        if histogram is None:
+            histogram = samples[key] = Histogram()
+        histogram.observe(value)
+
+    @staticmethod
+    def _labels(labels, **extra) -> str:
+        pairs = [*labels, *extra.items()]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def render(self) -> str:
+        worker = (("worker", WORKER_ID),)
+        lines = []
+        for name, (kind, help_text, samples) in self._families.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for key, value in list(samples.items()):
+                labels = worker + key
+                if kind == "counter":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip((*value.buckets, "+Inf"), value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{self._labels(labels)} {value.count}")
+        for name, (help_text, func) in self._gauges.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            value = func()
+            for key, sample in value if isinstance(value, list) else [((), value)]:
+                lines.append(f"{name}{self._labels(worker + tuple(key))} {sample}")
+        return "\n".join(lines) + "\n"
+
+    def total(self, name: str) -> float:
+        """Сумма счётчика по всем меткам."""
+        return sum(self._families[name][2].values())
+
+    async def watch_loop_lag(self, interval: float = 0.5):
+        """Фоновая задача: насколько позже запланированного просыпается event loop."""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            self.observe("bot_event_loop_lag_seconds", max(0.0, loop.time() - started - interval))
+
+
+metrics = Metrics()
+metrics.counter("bot_updates_total", "Обновления, полученные вебхуком")
+metrics.counter("bot_updates_duplicate_total", "Повторные доставки, отброшенные по update_id")
+metrics.counter("bot_updates_rejected_total", "Обновления, отклонённые до диспетчера, по причине")
+metrics.histogram("bot_handler_seconds", "Время работы хэндлера")
+metrics.counter("bot_handler_errors_total", "Исключения в хэндлерах по типу")
+metrics.histogram("bot_db_query_seconds", "Время запроса к SQLite в потоке БД")
+metrics.histogram("bot_outbound_wait_seconds", "Ожидание в очереди отправки")
+metrics.histogram("bot_outbound_request_seconds", "Время запроса к Bot API")
+metrics.counter("bot_outbound_errors_total", "Ошибки запросов к Bot API по типу")
+metrics.counter("bot_broadcast_messages_total", "Сообщения рассылок по результату")
+metrics.histogram("bot_event_loop_lag_seconds", "Задержка пробуждения event loop")
+metrics.histogram("bot_db_maintenance_seconds", "Время задач обслуживания БД")
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время каждого хэндлера (подключается как inner middleware)."""
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        trace = UPDATE_TRACE.get()
+        if trace is not None:
+            trace.handler = name
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            metrics.inc("bot_handler_errors_total", handler=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_handler_seconds", elapsed, handler=name)
+            if trace is not None:
+                trace.add("handler", elapsed)
+
+
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+
+class UpdateTrace:
+    """Время обработки одного обновления по этапам."""
+
+    __slots__ = ("started", "handler", "stages")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.handler = None
+        # этап -> [секунды, число вызовов]
+        self.stages: dict[str, list] = {}
+
+    def add(self, stage: str, seconds: float):
+        entry = self.stages.get(stage)
+        if entry is None:
+            self.stages[stage] = [seconds, 1]
+        else:
+            entry[0] += seconds
+            entry[1] += 1
+
+
+# Трассировка обновления, которое обрабатывает текущая задача
+UPDATE_TRACE: ContextVar[UpdateTrace | None] = ContextVar("UPDATE_TRACE", default=None)
+
+
+def trace_stage(stage: str, seconds: float):
+    """Добавляет время этапа к текущему обновлению (если оно есть)."""
+    trace = UPDATE_TRACE.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+class UpdateProfilerMiddleware(BaseMiddleware):
+    """Пишет в лог обновления дольше SLOW_UPDATE_THRESHOLD с разбивкой по этапам.
+
+    Время хэндлера, запросов к SQLite и к Bot API собирают сами эти слои
+    через trace_stage(); всё остальное - роутинг, фильтры и middleware.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+
+    async def __call__(self, handler, event, data):
+        trace = UpdateTrace()
+        token = UPDATE_TRACE.set(trace)
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_TRACE.reset(token)
+            total = time.perf_counter() - trace.started
+            if total >= self.threshold:
+                self._log(event, trace, total)
+
+    @staticmethod
+    def _log(event, trace: UpdateTrace, total: float):
+        handler_time = trace.stages.get("handler", [0.0])[0]
+        parts = [f"роутинг и фильтры {(total - handler_time) * 1000:.0f} мс"]
+        for stage, (seconds, calls) in sorted(trace.stages.items(), key=lambda item: -item[1][0]):
+            parts.append(f"{stage} {seconds * 1000:.0f} мс" + (f" ({calls})" if calls > 1 else ""))
+        logging.warning(
+            f"Медленное обновление {event.update_id} ({event.event_type}, {trace.handler or 'без хэндлера'}): "
+            f"{total * 1000:.0f} мс: " + ", ".join(parts)
+        )
+
+
+dp.update.outer_middleware(UpdateProfilerMiddleware(SLOW_UPDATE_THRESHOLD))
+
+
+class SamplingProfiler:
+    """Семплирующий профайлер на время /profile.
+
+    Таймер ITIMER_PROF каждые interval секунд процессорного времени
+    присылает SIGPROF, обработчик сигнала записывает стек, на котором
+    остановился поток event loop, и считает одинаковые стеки. Простой в
+    ожидании событий в профиль не попадает. Результат - collapsed stacks
+    ("кадр;кадр;кадр число"), которые понимают flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.running = False
+        self._counts: dict[str, int] = {}
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    async def profile(self, seconds: float) -> tuple[str, int]:
+        """Семплирует seconds секунд, возвращает (collapsed stacks, число снимков)."""
+        self.running = True
+        self._counts = {}
+        previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+            self.running = False
+        counts = self._counts
+        lines = [f"{stack} {count}" for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+        return "\n".join(lines) + "\n", sum(counts.values())
+
+
+profiler = SamplingProfiler()
+
+
+# --- ================================== ---
+# ---       БЛОК: БАЗА ДАННЫХ (SQLITE)   ---
+# --- ================================== ---
+
+class Storage:
+    """Долгоживущее соединение с SQLite.
+
+    Соединение одно на весь процесс, все блокирующие вызовы выполняются
+    в отдельном потоке, поэтому коммит с fsync не останавливает event loop.
+    Время каждого вызова попадает в гистограмму bot_db_query_seconds с меткой
+    op - именем запроса, которое передаёт вызывающий код.
+    """
+
+    PRAGMAS = (
+        # Действует только для новой базы (до создания таблиц): старую
+        # переводит в этот режим лишь VACUUM
+        "PRAGMA auto_vacuum=INCREMENTAL",
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=134217728",
+        "PRAGMA busy_timeout=5000",
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._executor: ThreadPoolExecutor | None = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # cached_statements держит подготовленные запросы: SQL-строки ниже
+        # константные, поэтому повторно они не компилируются
+        conn = sqlite3.connect(self.path, cached_statements=256)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _call(self, func, args, op):
+        if self._conn is None:
+            self._conn = self._connect()
+        started = time.perf_counter()
+        try:
+            return func(self._conn, *args)
+        finally:
+            metrics.observe("bot_db_query_seconds", time.perf_counter() - started, op=op)
+
+    async def run(self, func, *args, op: str | None = None):
+        """Выполняет func(conn, *args) в потоке БД и возвращает результат.
+
+        op - метка в метриках, по умолчанию имя func.
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, self._call, func, args, op or func.__name__)
+        finally:
+            trace_stage("sqlite", time.perf_counter() - started)
+
+    async def execute(self, sql: str, params=(), *, op: str) -> int:
+        """Выполняет запрос на запись в отдельной транзакции."""
+        def _execute(conn):
+            with conn:
+                return conn.execute(sql, params).rowcount
+        return await self.run(_execute, op=op)
+
+    async def executemany(self, sql: str, seq_of_params, *, op: str) -> int:
+        def _executemany(conn):
+            with conn:
+                return conn.executemany(sql, seq_of_params).rowcount
+        return await self.run(_executemany, op=op)
+
+    async def fetchone(self, sql: str, params=(), *, op: str):
+        def _fetchone(conn):
+            return conn.execute(sql, params).fetchone()
+        return await self.run(_fetchone, op=op)
+
+    async def fetchall(self, sql: str, params=(), *, op: str):
+        def _fetchall(conn):
+            return conn.execute(sql, params).fetchall()
+        return await self.run(_fetchall, op=op)
+
+    async def close(self):
+        """Закрывает соединение и останавливает поток БД."""
+        if self._executor is None:
+            return
+        def _close(conn):
+            conn.close()
+        await self.run(_close)
+        self._conn = None
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+storage = Storage(DB_PATH)
+
+# Фоновые задачи (очистка таблиц и т.п.), отменяются при остановке
+BACKGROUND_TASKS: list[asyncio.Task] = []
+
+
+async def run_periodically(interval: float, func, name: str):
+    """Вызывает корутину func каждые interval секунд, не падая на ошибках."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await func()
+        except Exception as e:
+            logging.error(f"Ошибка фоновой задачи '{name}': {e}")
+
+
+class DatabaseMaintenance:
+    """Обслуживание SQLite в периоды затишья (только в процессе 0).
+
+    Раз в interval секунд смотрит, сколько обновлений пришло с прошлой
+    проверки. Если их меньше quiet и не идёт рассылка, сбрасывает WAL в
+    основной файл, а реже - обновляет статистику планировщика и возвращает
+    свободные страницы. Любой шаг может подождать до следующего затишья.
+    """
+
+    OPTIMIZE_EVERY = 3600
+    ANALYZE_EVERY = 86400
+    VACUUM_PAGES = 2000
+    # Строк на индекс, которые смотрит ANALYZE: статистика приблизительная, зато быстро
+    ANALYSIS_LIMIT = 1000
+
+    def __init__(self, quiet: int):
+        self.quiet = quiet
+        self._updates = 0.0
+        # Отсчёт от запуска: полный ANALYZE не должен идти в первое же затишье после старта
+        self._optimized = self._analyzed = time.time()
+
+    @staticmethod
+    def _timed(conn: sqlite3.Connection, task: str, sql: str, times: int = 1):
+        started = time.perf_counter()
+        for _ in range(times):
+            result = conn.execute(sql).fetchall()
+        metrics.observe("bot_db_maintenance_seconds", time.perf_counter() - started, task=task)
+        return result
+
+    def _maintain(self, conn: sqlite3.Connection, now: float):
+        if conn.execute("SELECT 1 FROM broadcasts WHERE status = 'running' LIMIT 1").fetchone():
+            return
+        # TRUNCATE не даёт WAL разрастаться; не выйдет, если кто-то читает - тогда в следующий раз
+        busy, _, _ = self._timed(conn, "checkpoint", "PRAGMA wal_checkpoint(TRUNCATE)")[0]
+        if busy:
+            logging.info("Чекпоинт WAL отложен: база занята")
+        if now - self._analyzed >= self.ANALYZE_EVERY:
+            conn.execute(f"PRAGMA analysis_limit = {self.ANALYSIS_LIMIT}")
+            self._timed(conn, "analyze", "ANALYZE")
+            self._analyzed = self._optimized = now
+        elif now - self._optimized >= self.OPTIMIZE_EVERY:
+            self._timed(conn, "optimize", "PRAGMA optimize")
+            self._optimized = now
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free:
+            # sqlite3 выполняет шаг PRAGMA один раз, а каждый шаг incremental_vacuum
+            # освобождает одну страницу - поэтому цикл, в одной транзакции
+            with conn:
+                conn.execute("BEGIN")
+                self._timed(conn, "vacuum", "PRAGMA incremental_vacuum(1)", min(free, self.VACUUM_PAGES))
+
+    async def tick(self):
+        updates = metrics.total("bot_updates_total")
+        recent, self._updates = updates - self._updates, updates
+        if recent >= self.quiet:
+            return
+        await storage.run(self._maintain, time.time(), op="db_maintenance")
+
+
+db_maintenance = DatabaseMaintenance(DB_MAINTENANCE_QUIET)
+
+
+class ChangeFeed:
+    """Оповещения процессов друг друга об изменениях общего состояния.
+
+    Процесс, изменивший бан/блокировку пользователя, диалог или список
+    админов, пишет событие в таблицу change_log; остальные процессы
+    периодически читают новые события и обновляют свои кэши. В режиме
+    одного процесса выключена и ничего не пишет.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.last_seq = 0
+
+    def publish_sync(self, conn: sqlite3.Connection, kind: str, keys):
+        """Пишет события в открытую транзакцию (вызывается в потоке БД)."""
+        if self.enabled and keys:
+            now = time.time()
+            conn.executemany(
+                "INSERT INTO change_log (origin, kind, key, created_at) VALUES (?, ?, ?, ?)",
+                [(os.getpid(), kind, key, now) for key in keys]
+            )
+
+    async def publish(self, kind: str, key: int = 0):
+        if self.enabled:
+            def _publish(conn):
+                with conn:
+                    self.publish_sync(conn, kind, [key])
+            await storage.run(_publish, op="change_log_publish")
+
+    async def start(self):
+        """Запоминает текущую позицию журнала: старые события к процессу не относятся."""
+        row = await storage.fetchone("SELECT MAX(seq) FROM change_log", op="change_log_start")
+        self.last_seq = row[0] or 0
+
+    async def poll(self):
+        rows = await storage.fetchall(
+            "SELECT seq, origin, kind, key FROM change_log WHERE seq > ? ORDER BY seq", (self.last_seq,),
+            op="change_log_poll"
+        )
+        if not rows:
+            return
+        self.last_seq = rows[-1][0]
+        users, reload_admins = set(), False
+        for _, origin, kind, key in rows:
+            if origin == os.getpid():
+                continue
+            if kind == "user":
+                users.add(key)
+            elif kind == "conversation":
+                conversations.forget(key)
+            elif kind == "admins":
+                reload_admins = True
+        if users:
+            placeholders = ",".join("?" * len(users))
+            for user_id, is_banned, is_blocked in await storage.fetchall(
+                f"SELECT user_id, is_banned, is_blocked_bot FROM users WHERE user_id IN ({placeholders})",
+                tuple(users),
+                op="change_log_users"
+            ):
+                user_cache.set_banned(user_id, bool(is_banned))
+                user_cache.set_blocked(user_id, bool(is_blocked))
+        if reload_admins:
+            await db_load_admins()
+
+    async def prune(self):
+        await storage.execute("DELETE FROM change_log WHERE created_at < ?", (time.time() - 600,), op="change_log_prune")
+
+
+change_feed = ChangeFeed(MULTIPROCESS)
+
+
+class UserStatusCache:
+    """Кэш статусов пользователей в памяти.
+
+    Хранит только множества ID забаненных и заблокировавших бота: таких
+    пользователей меньшинство, а отсутствие ID в множестве означает "нет".
+    Прогревается из таблицы users при запуске и обновляется сквозной записью.
+    """
+
+    def __init__(self):
+        self.banned: set[int] = set()
+        self.blocked: set[int] = set()
+        self.ready = False
+        # Проверки бана, которые кэш не смог ответить и которые ушли в SQLite
+        self.db_reads = 0
+
+    def load(self, rows):
+        """Заполняет кэш строками (user_id, is_banned, is_blocked_bot)."""
+        self.banned = {user_id for user_id, is_banned, _ in rows if is_banned}
+        self.blocked = {user_id for user_id, _, is_blocked in rows if is_blocked}
+        self.ready = True
+
+    def is_banned(self, user_id: int) -> bool | None:
+        """Возвращает статус бана или None, если кэш ещё не прогрет."""
+        if not self.ready:
+            return None
+        return user_id in self.banned
+
+    def set_banned(self, user_id: int, status: bool):
+        if status:
+            self.banned.add(user_id)
+        else:
+            self.banned.discard(user_id)
+
+    def set_blocked(self, user_id: int, status: bool):
+        if status:
+            self.blocked.add(user_id)
+        else:
+            self.blocked.discard(user_id)
+
+    def memory_bytes(self) -> int:
+        """Примерный объём памяти: сами множества и хранящиеся в них int."""
+        size = sys.getsizeof(self.banned) + sys.getsizeof(self.blocked)
+        size += sum(sys.getsizeof(user_id) for user_id in self.banned)
+        size += sum(sys.getsizeof(user_id) for user_id in self.blocked)
+        return size
+
+    def stats(self) -> dict:
+        return {
+            "banned": len(self.banned),
+            "blocked": len(self.blocked),
+            "memory_bytes": self.memory_bytes(),
+            "db_reads": self.db_reads,
+        }
+
+
+user_cache = UserStatusCache()
+
+
+class BatchWriter(ABC):
+    """Фоновая запись в БД пачками (write-behind).
+
+    Записи копятся в self.pending и сбрасываются одной транзакцией раз в
+    interval секунд или как только их накопится max_pending. Наследник
+    задаёт пустой буфер (_empty), саму запись (_write) и возврат
+    несохранённого при ошибке (_requeue).
+    """
+
+    name = "пачки"
+    # Метка op в bot_db_query_seconds
+    op = "batch_write"
+
+    def __init__(self, interval: float, max_pending: int):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = self._empty()
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self.flushes = 0
+        self.flushed_entries = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    @abstractmethod
+    def _empty(self):
+        """Пустой буфер."""
+
+    @staticmethod
+    @abstractmethod
+    def _write(conn: sqlite3.Connection, batch):
+        """Пишет пачку в БД (вызывается в потоке БД)."""
+
+    @abstractmethod
+    def _requeue(self, batch):
+        """Возвращает в буфер пачку, которую не удалось записать."""
+
+    def _added(self):
+        if len(self.pending) >= self.max_pending:
+            self._full.set()
+
+    async def flush(self):
+        """Записывает накопленное в БД (после этого чтения из БД видят все записи)."""
+        async with self._lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, self._empty()
+            self._full.clear()
+            started = time.perf_counter()
+            try:
+                await storage.run(self._write, batch, op=self.op)
+            except Exception:
+                self._requeue(batch)
+                raise
+            latency = time.perf_counter() - started
+            self.flushes += 1
+            self.flushed_entries += len(batch)
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.pending),
+            "flushes": self.flushes,
+            "flushed_entries": self.flushed_entries,
+            "last_latency_ms": self.last_latency * 1000,
+            "avg_latency_ms": self.total_latency / self.flushes * 1000 if self.flushes else 0.0,
+            "max_latency_ms": self.max_latency * 1000,
+        }
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись и сохраняет остаток."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"Ошибка записи {self.name}: {e}")
+
+
+class UserJournal(BatchWriter):
+    """Отложенная запись состояния пользователей.
+
+    Добавления, флаги бана/блокировки и время последней активности копятся
+    в памяти по одной записи на пользователя (новые значения перекрывают
+    старые); сбрасывает их BatchWriter.
+    """
+
+    name = "журнала пользователей"
+    op = "users_journal_flush"
+
+    def _empty(self) -> dict[int, dict]:
+        # user_id -> {"add": True, "banned": bool, "blocked": bool, "last_seen": float}
+        return {}
+
+    def _requeue(self, batch: dict[int, dict]):
+        # Возвращаем несохранённое, не затирая более свежие значения
+        for user_id, fields in batch.items():
+            self.pending[user_id] = {**fields, **self.pending.get(user_id, {})}
+
+    def _update(self, user_id: int, **fields):
+        self.pending.setdefault(user_id, {}).update(fields)
+        self._added()
+
+    def add_user(self, user_id: int):
+        self._update(user_id, add=True, blocked=False, last_seen=time.time())
+
+    def set_banned(self, user_id: int, status: bool):
+        self._update(user_id, banned=status)
+
+    def set_blocked(self, user_id: int, status: bool):
+        self._update(user_id, blocked=status)
+
+    def touch(self, user_id: int):
+        self._update(user_id, last_seen=time.time())
+
+    def pending_banned(self, user_id: int) -> bool | None:
+        """Бан, ещё не записанный в БД (None, если его нет)."""
+        return self.pending.get(user_id, {}).get("banned")
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, batch: dict[int, dict]):
+        added, banned, blocked, seen = [], [], [], []
+        for user_id, fields in batch.items():
+            if fields.get("add"):
+                added.append((user_id, fields["last_seen"]))
+            if "banned" in fields:
+                banned.append((user_id, 1 if fields["banned"] else 0))
+            if "blocked" in fields:
+                blocked.append((1 if fields["blocked"] else 0, user_id))
+            if "last_seen" in fields:
+                seen.append((fields["last_seen"], user_id))
+        with conn:
+            conn.executemany(SQL_ADD_USER, added)
+            conn.executemany(SQL_UPSERT_BANNED, banned)
+            conn.executemany(SQL_DROP_UNSTARTED, [(user_id,) for user_id, is_banned in banned if not is_banned])
+            conn.executemany(SQL_SET_BLOCKED, blocked)
+            conn.executemany(SQL_SET_LAST_SEEN, seen)
+            change_feed.publish_sync(
+                conn, "user", [user_id for user_id, fields in batch.items() if "banned" in fields or "blocked" in fields]
+            )
+
+
+user_journal = UserJournal(USER_JOURNAL_INTERVAL, USER_JOURNAL_MAX_ENTRIES)
+
+
+class AdminRegistry:
+    """Админы бота: admin_id -> имя.
+
+    Объект живёт всё время работы бота и меняется на месте, поэтому фильтры
+    F.from_user.id.in_(ADMINS_DB) видят админов, добавленных после запуска.
+    version растёт при каждом изменении - по ней перестраиваются зависящие
+    от списка кэши (инлайн-клавиатура).
+    """
+
+    def __init__(self):
+        self._admins: dict[int, str] = {}
+        self.version = 0
+
+    def __contains__(self, admin_id) -> bool:
+        return admin_id in self._admins
+
+    def __getitem__(self, admin_id: int) -> str:
+        return self._admins[admin_id]
+
+    def __len__(self) -> int:
+        return len(self._admins)
+
+    def get(self, admin_id: int, default: str | None = None) -> str | None:
+        return self._admins.get(admin_id, default)
+
+    def items(self):
+        return self._admins.items()
+
+    def load(self, rows):
+        self._admins = dict(rows)
+        self.version += 1
+
+    def add(self, admin_id: int, admin_name: str):
+        if self._admins.get(admin_id) != admin_name:
+            self._admins[admin_id] = admin_name
+            self.version += 1
+
+    def remove(self, admin_id: int):
+        if self._admins.pop(admin_id, None) is not None:
+            self.version += 1
+
+
+ADMINS_DB = AdminRegistry()
+
+# Строка могла появиться раньше /start - от бана (started = 0): тогда /start её "засчитывает"
+SQL_ADD_USER = (
+    "INSERT INTO users (user_id, joined_at) VALUES (?, ?) "
+    "ON CONFLICT (user_id) DO UPDATE SET started = 1, joined_at = excluded.joined_at WHERE started = 0"
+)
+SQL_UPSERT_BANNED = (
+    "INSERT INTO users (user_id, is_banned, started) VALUES (?, ?, 0) "
+    "ON CONFLICT (user_id) DO UPDATE SET is_banned = excluded.is_banned"
+)
+# Разбаненный, так и не нажавший /start, - снова никто: строка больше не нужна
+SQL_DROP_UNSTARTED = "DELETE FROM users WHERE user_id = ? AND started = 0 AND is_banned = 0"
+SQL_SET_BLOCKED = "UPDATE users SET is_blocked_bot = ? WHERE user_id = ?"
+SQL_SET_LAST_SEEN = "UPDATE users SET last_seen = ? WHERE user_id = ?"
+SQL_IS_BANNED = "SELECT is_banned FROM users WHERE user_id = ?"
+SQL_FLAGGED_USERS = "SELECT user_id, is_banned, is_blocked_bot FROM users WHERE is_banned = 1 OR is_blocked_bot = 1"
+SQL_ADMINS = "SELECT admin_id, admin_name FROM admins"
+
+
+def _db_add_column(conn: sqlite3.Connection, table: str, column: str, declaration: str):
+    """Добавляет колонку в существующую таблицу, если её там нет"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+def _migration_base(conn: sqlite3.Connection):
+    """Схема на момент появления миграций. Повторяемая: базы прошлых версий
+    бота могли уже содержать часть таблиц и колонок"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            is_banned INTEGER DEFAULT 0,
+            is_blocked_bot INTEGER DEFAULT 0,
+            last_seen REAL,
+            joined_at REAL
+        )
+    """)
+    # В базах, созданных раньше, этих колонок ещё нет
+    _db_add_column(conn, "users", "last_seen", "REAL")
+    _db_add_column(conn, "users", "joined_at", "REAL")
+    # Частичный индекс для рассылок: только активные пользователи, с полями сегментов
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_active ON users (user_id, last_seen, joined_at)
+        WHERE is_blocked_bot = 0 AND is_banned = 0
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS admins (
+            admin_id INTEGER PRIMARY KEY,
+            admin_name TEXT
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner_id INTEGER NOT NULL,
+            text TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            caption TEXT,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            segment TEXT,
+            runner TEXT
+        )
+    """)
+    _db_add_column(conn, "broadcasts", "segment", "TEXT")
+    _db_add_column(conn, "broadcasts", "runner", "TEXT")
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER PRIMARY KEY,
+            admin_id INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at)"
+    )
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_links (
+            admin_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (admin_id, message_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_message_links_created_at ON message_links (created_at)"
+    )
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id INTEGER PRIMARY KEY,
+            received_at REAL NOT NULL
+        )
+    """)
+
+    _db_init_stats(conn)
+    _db_init_archive(conn)
+
+def _db_init_stats(conn: sqlite3.Connection):
+    """Счётчики статистики, которые триггеры обновляют при каждом изменении users"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (day, metric)
+        ) WITHOUT ROWID
+    """)
+
+    # Один раз считаем счётчики по уже существующим пользователям
+    if conn.execute("SELECT COUNT(name) FROM stats_counters").fetchone()[0] == 0:
+        conn.execute("""
+            INSERT INTO stats_counters (name, value)
+            SELECT 'total', COUNT(user_id) FROM users
+            UNION ALL SELECT 'banned', COUNT(user_id) FROM users WHERE is_banned = 1
+            UNION ALL SELECT 'blocked', COUNT(user_id) FROM users WHERE is_blocked_bot = 1
+        """)
+
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total';
+            UPDATE stats_counters SET value = value + NEW.is_banned WHERE name = 'banned';
+            UPDATE stats_counters SET value = value + NEW.is_blocked_bot WHERE name = 'blocked';
+            INSERT INTO stats_daily (day, metric, value) VALUES (date('now'), 'new_users', 1)
+                ON CONFLICT (day, metric) DO UPDATE SET value = value + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'total';
+            UPDATE stats_counters SET value = value - OLD.is_banned WHERE name = 'banned';
+            UPDATE stats_counters SET value = value - OLD.is_blocked_bot WHERE name = 'blocked';
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_banned AFTER UPDATE OF is_banned ON users
+        WHEN NEW.is_banned != OLD.is_banned
+        BEGIN
+            UPDATE stats_counters SET value = value + NEW.is_banned - OLD.is_banned WHERE name = 'banned';
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_blocked AFTER UPDATE OF is_blocked_bot ON users
+        WHEN NEW.is_blocked_bot != OLD.is_blocked_bot
+        BEGIN
+            UPDATE stats_counters SET value = value + NEW.is_blocked_bot - OLD.is_blocked_bot WHERE name = 'blocked';
+            INSERT INTO stats_daily (day, metric, value)
+                SELECT date('now'), 'blocks', 1 WHERE NEW.is_blocked_bot = 1
+                ON CONFLICT (day, metric) DO UPDATE SET value = value + 1;
+        END
+    """)
+
+def _db_init_archive(conn: sqlite3.Connection):
+    """Архив переписки и его полнотекстовый индекс"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            admin_id INTEGER NOT NULL,
+            direction TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_user ON messages (user_id, id)")
+    try:
+        # External content: текст хранится только в messages, индекс - в messages_fts
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logging.warning(f"FTS5 недоступен, /search работать не будет: {e}")
+        return
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_messages_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, text) VALUES (NEW.id, NEW.text);
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_messages_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+        END
+    """)
+
+def _migration_indexes(conn: sqlite3.Connection):
+    """Индексы под частые запросы, которые раньше читали таблицы целиком"""
+    # Загрузка кэша банов/блокировок при запуске: покрывающий частичный индекс
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_flagged ON users (user_id, is_banned, is_blocked_bot)
+        WHERE is_banned = 1 OR is_blocked_bot = 1
+    """)
+    # Нагрузка админов и передача диалогов удалённого админа
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_admin ON conversations (admin_id, updated_at)")
+    # Поиск незавершённых рассылок при запуске и в /broadcasts
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_broadcasts_active ON broadcasts (job_id)
+        WHERE status IN ('running', 'paused')
+    """)
+    # Статистика для планировщика запросов. Выборочная, как в DatabaseMaintenance:
+    # миграция идёт при запуске, до /ready, и полный ANALYZE большой базы задержал бы старт
+    conn.execute(f"PRAGMA analysis_limit = {DatabaseMaintenance.ANALYSIS_LIMIT}")
+    conn.execute("ANALYZE")
+
+
+def _migration_broadcast_media(conn: sqlite3.Connection):
+    """Рассылки альбомов и файлов с диска"""
+    # Список элементов рассылки (тип, file_id, подпись) в JSON
+    _db_add_column(conn, "broadcasts", "media", "TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_group_parts (
+            media_group_id TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            item TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (media_group_id, message_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS uploaded_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            uploaded_at REAL NOT NULL
+        )
+    """)
+
+
+def _migration_broadcast_schedule(conn: sqlite3.Connection):
+    """Отложенные рассылки и рассылки, растянутые на время"""
+    _db_add_column(conn, "broadcasts", "start_at", "REAL")
+    _db_add_column(conn, "broadcasts", "finish_at", "REAL")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_broadcasts_scheduled ON broadcasts (start_at)
+        WHERE status = 'scheduled'
+    """)
+
+def _migration_ban_before_start(conn: sqlite3.Connection):
+    """Бан пользователя, ещё не нажимавшего /start, не считается новым пользователем"""
+    # Все существующие строки созданы /start (или их не отличить), поэтому по умолчанию 1
+    _db_add_column(conn, "users", "started", "INTEGER NOT NULL DEFAULT 1")
+    conn.execute("DROP TRIGGER IF EXISTS trg_users_insert")
+    conn.execute("DROP TRIGGER IF EXISTS trg_users_delete")
+    conn.execute("""
+        CREATE TRIGGER trg_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats_counters SET value = value + NEW.started WHERE name = 'total';
+            UPDATE stats_counters SET value = value + NEW.is_banned WHERE name = 'banned';
+            UPDATE stats_counters SET value = value + NEW.is_blocked_bot WHERE name = 'blocked';
+            INSERT INTO stats_daily (day, metric, value)
+                SELECT date('now'), 'new_users', 1 WHERE NEW.started = 1
+                ON CONFLICT (day, metric) DO UPDATE SET value = value + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER trg_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats_counters SET value = value - OLD.started WHERE name = 'total';
+            UPDATE stats_counters SET value = value - OLD.is_banned WHERE name = 'banned';
+            UPDATE stats_counters SET value = value - OLD.is_blocked_bot WHERE name = 'blocked';
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_users_started AFTER UPDATE OF started ON users
+        WHEN NEW.started = 1 AND OLD.started = 0
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'total';
+            INSERT INTO stats_daily (day, metric, value) VALUES (date('now'), 'new_users', 1)
+                ON CONFLICT (day, metric) DO UPDATE SET value = value + 1;
+        END
+    """)
+
+
+# Миграции схемы по порядку; номер применённой хранится в PRAGMA user_version.
+# Новые изменения схемы - только новыми функциями в конце списка
+MIGRATIONS = [
+    _migration_base,
+    _migration_indexes,
+    _migration_broadcast_media,
+    _migration_broadcast_schedule,
+    _migration_ban_before_start,
+]
+
+
+def _db_init_sync(conn: sqlite3.Connection):
+    """Применяет к базе недостающие миграции, каждую в своей транзакции"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        # BEGIN IMMEDIATE сразу берёт блокировку записи: два процесса не
+        # применят одну миграцию дважды
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= number:
+                conn.rollback()
+                continue
+            started = time.perf_counter()
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logging.info(f"Миграция БД {number} ({migration.__name__}) применена за "
+                     f"{(time.perf_counter() - started) * 1000:.0f} мс")
+
+async def db_init():
+    """Инициализирует базу данных"""
+    await storage.run(_db_init_sync, op="db_init")
+
+async def db_add_user(user_id: int):
+    """Добавляет пользователя в БД при /start (через журнал)"""
+    user_journal.add_user(user_id)
+    user_cache.set_blocked(user_id, False)
+
+async def db_ban_user(user_id: int, status: bool):
+    """Блокирует или разблокирует пользователя (админом, через журнал)"""
+    # Если пользователь ещё не нажимал /start, строка создаётся с баном и started = 0:
+    # в счётчики нажавших /start он попадёт, только когда действительно его нажмёт
+    user_journal.set_banned(user_id, status)
+    user_cache.set_banned(user_id, status)
+
+async def db_touch_user(user_id: int):
+    """Обновляет время последней активности пользователя (через журнал)"""
+    user_journal.touch(user_id)
+
+async def db_is_user_banned(user_id: int) -> bool:
+    """Проверяет, забанен ли юзер админом"""
+    cached = user_cache.is_banned(user_id)
+    if cached is not None:
+        return cached
+    pending = user_journal.pending_banned(user_id)
+    if pending is not None:
+        return pending
+    user_cache.db_reads += 1
+    result = await storage.fetchone(SQL_IS_BANNED, (user_id,), op="users_is_banned")
+    return result[0] == 1 if result else False
+
+async def db_set_user_blocked(user_id: int, status: bool):
+    """Помечает, что юзер заблокировал бота (при ошибке отправки, через журнал)"""
+    user_journal.set_blocked(user_id, status)
+    user_cache.set_blocked(user_id, status)
+
+async def db_load_caches():
+    """Прогревает кэш статусов пользователей и кэш админов.
+
+    Поток БД один, так что параллельные запросы всё равно шли бы по
+    очереди: оба читаются за один заход в поток.
+    """
+    def _load_caches(conn):
+        return conn.execute(SQL_FLAGGED_USERS).fetchall(), conn.execute(SQL_ADMINS).fetchall()
+    flagged, admins = await storage.run(_load_caches, op="startup_caches")
+    user_cache.load(flagged)
+    ADMINS_DB.load(admins)
+    logging.info(f"Кэш статусов: забанено {len(user_cache.banned)}, заблокировали бота {len(user_cache.blocked)}")
+    logging.info(f"Загружено админов: {len(ADMINS_DB)}")
+
+
+async def db_get_stats():
+    """Получает статистику из БД (счётчики, без сканирования users)"""
+    await user_journal.flush()
+    rows = await storage.fetchall("SELECT name, value FROM stats_counters", op="stats_counters")
+    stats = {"total": 0, "banned": 0, "blocked": 0}
+    stats.update(rows)
+    return stats
+
+async def db_get_daily_stats(days: int = 7) -> dict[str, dict[str, int]]:
+    """Статистика по дням: {день: {метрика: значение}} за последние days дней"""
+    rows = await storage.fetchall(
+        "SELECT day, metric, value FROM stats_daily WHERE day > date('now', ?) ORDER BY day",
+        (f"-{days} days",),
+        op="stats_daily"
+    )
+    daily = {}
+    for day, metric, value in rows:
+        daily.setdefault(day, {})[metric] = value
+    return daily
+
+# Пересланные сообщения считаются в памяти и сбрасываются в stats_daily пачкой
+RELAYED_PENDING: dict[str, int] = {}
+
+def stats_count_relayed():
+    """Учитывает одно пересланное сообщение (пользователь <-> админ)"""
+    day = time.strftime("%Y-%m-%d", time.gmtime())
+    RELAYED_PENDING[day] = RELAYED_PENDING.get(day, 0) + 1
+
+async def db_flush_relayed():
+    """Записывает накопленные счётчики пересланных сообщений в stats_daily"""
+    if not RELAYED_PENDING:
+        return
+    pending = list(RELAYED_PENDING.items())
+    RELAYED_PENDING.clear()
+    await storage.executemany(
+        "INSERT INTO stats_daily (day, metric, value) VALUES (?, 'messages', ?) "
+        "ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value",
+        pending,
+        op="stats_relayed"
+    )
+
+async def db_load_admins():
+    """Загружает админов из БД в кэш ADMINS_DB"""
+    ADMINS_DB.load(await storage.fetchall(SQL_ADMINS, op="admins_load"))
+    logging.info(f"Загружено админов: {len(ADMINS_DB)}")
+
+async def db_add_admin(admin_id: int, admin_name: str):
+    await storage.execute(
+        "INSERT OR REPLACE INTO admins (admin_id, admin_name) VALUES (?, ?)", (admin_id, admin_name),
+        op="admins_add"
+    )
+    ADMINS_DB.add(admin_id, admin_name) # Обновляем кэш
+    await change_feed.publish("admins")
+
+async def db_del_admin(admin_id: int):
+    await storage.execute("DELETE FROM admins WHERE admin_id = ?", (admin_id,), op="admins_del")
+    ADMINS_DB.remove(admin_id) # Обновляем кэш
+    await change_feed.publish("admins")
+    # Собеседники удалённого админа переходят к наименее загруженным
+    admin_relay.forget(admin_id)
+    moves = await conversations.reassign(admin_id)
+    if moves:
+        logging.info(f"Диалоги админа {admin_id} переданы другим админам: {len(moves)}")
+        task = asyncio.create_task(notify_reassigned(moves))
+        BACKGROUND_TASKS.append(task)
+        task.add_done_callback(BACKGROUND_TASKS.remove)
+
+async def notify_reassigned(moves: list[tuple[int, int]]):
+    """Сообщает пользователям их нового админа (в полосе рассылок, чтобы не тормозить диалоги)."""
+    SEND_LANE.set("broadcast")
+    for admin_id, user_id in moves:
+        try:
+            await bot.send_message(
+                user_id,
+                f"Админ, с которым вы общались, больше недоступен. Ваш новый собеседник: "
+                f"{ADMINS_DB.get(admin_id, 'Администратор')}."
+            )
+        except Exception as e:
+            logging.error(f"Не удалось сообщить пользователю {user_id} о смене админа: {e}")
+
+async def db_seed_owners(owners: dict[int, str]):
+    """Добавляет в админы владельцев, которых там ещё нет, одной транзакцией."""
+    missing = [(owner_id, name) for owner_id, name in owners.items() if owner_id not in ADMINS_DB]
+    if not missing:
+        return
+    for owner_id, name in missing:
+        logging.info(f"Владелец {owner_id} ({name}) не найден в админах. Добавляю...")
+    await storage.executemany("INSERT OR REPLACE INTO admins (admin_id, admin_name) VALUES (?, ?)", missing, op="admins_seed")
+    for owner_id, name in missing:
+        ADMINS_DB.add(owner_id, name)
+    await change_feed.publish("admins")
+
+
+# --- ================================== ---
+# ---         БЛОК: ДИАЛОГИ              ---
+# --- ================================== ---
+
+class AdminLoad:
+    """Нагрузка на админов: открытые диалоги и сообщения за последний час.
+
+    Нагрузка меняется только по событиям (диалог открыт или закрыт, пришло
+    сообщение, старое сообщение вышло из окна), и при каждом изменении в
+    кучу кладётся пара (нагрузка, admin_id). Устаревшие пары выбрасываются,
+    когда оказываются на вершине, поэтому и обновление, и выбор наименее
+    загруженного админа стоят O(log n).
+    """
+
+    def __init__(self, window: float = 3600, conversation_weight: int = 10):
+        self.window = window
+        # Открытый диалог весит как conversation_weight сообщений за окно
+        self.conversation_weight = conversation_weight
+        self.conversations: dict[int, int] = {}
+        self.messages: dict[int, int] = {}
+        self._recent: deque[tuple[float, int]] = deque()
+        self._heap: list[tuple[int, int]] = []
+        self._version = -1
+
+    def load(self, admin_id: int) -> int:
+        return self.conversations.get(admin_id, 0) * self.conversation_weight + self.messages.get(admin_id, 0)
+
+    def _rebuild(self):
+        self._heap = [(self.load(admin_id), admin_id) for admin_id, _ in ADMINS_DB.items()]
+        heapq.heapify(self._heap)
+        self._version = ADMINS_DB.version
+
+    def _push(self, admin_id: int):
+        if admin_id not in ADMINS_DB:
+            return
+        heapq.heappush(self._heap, (self.load(admin_id), admin_id))
+        if len(self._heap) > 4 * len(ADMINS_DB) + 64:
+            self._rebuild()
+
+    def _expire(self, now: float):
+        deadline = now - self.window
+        while self._recent and self._recent[0][0] < deadline:
+            _, admin_id = self._recent.popleft()
+            self.messages[admin_id] -= 1
+            if not self.messages[admin_id]:
+                del self.messages[admin_id]
+            self._push(admin_id)
+
+    def opened(self, admin_id: int):
+        self.conversations[admin_id] = self.conversations.get(admin_id, 0) + 1
+        self._push(admin_id)
+
+    def closed(self, admin_id: int):
+        count = self.conversations.get(admin_id, 0) - 1
+        if count > 0:
+            self.conversations[admin_id] = count
+        else:
+            self.conversations.pop(admin_id, None)
+        self._push(admin_id)
+
+    def message(self, admin_id: int):
+        now = time.time()
+        self._expire(now)
+        self._recent.append((now, admin_id))
+        self.messages[admin_id] = self.messages.get(admin_id, 0) + 1
+        self._push(admin_id)
+
+    def load_conversations(self, rows):
+        """Заменяет счётчики диалогов строками (admin_id, число) из БД."""
+        self.conversations = dict(rows)
+        self._rebuild()
+
+    def least_loaded(self) -> int | None:
+        if self._version != ADMINS_DB.version:
+            self._rebuild()
+        self._expire(time.time())
+        while self._heap:
+            load, admin_id = self._heap[0]
+            if admin_id in ADMINS_DB and load == self.load(admin_id):
+                return admin_id
+            heapq.heappop(self._heap)
+        return None
+
+    def stats(self) -> list[tuple[int, int, int]]:
+        """(admin_id, открытых диалогов, сообщений за окно) по всем админам."""
+        self._expire(time.time())
+        return [
+            (admin_id, self.conversations.get(admin_id, 0), self.messages.get(admin_id, 0))
+            for admin_id, _ in ADMINS_DB.items()
+        ]
+
+
+admin_load = AdminLoad()
+
+
+class ConversationStore:
+    """Какому админу пишет пользователь.
+
+    Источник истины - таблица conversations, перед ней стоит ограниченный
+    LRU-кэш (в том числе для пользователей без диалога), так что обычный
+    поиск не обращается к БД. Диалоги без активности дольше ttl истекают.
+    Открытие и закрытие диалогов учитывается в admin_load.
+    """
+
+    def __init__(self, ttl: float, cache_size: int, touch_interval: float = 60):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.touch_interval = touch_interval
+        # user_id -> (admin_id или None, время последней активности)
+        self._cache: OrderedDict[int, tuple[int | None, float]] = OrderedDict()
+
+    def _remember(self, user_id: int, admin_id: int | None, updated_at: float):
+        self._cache[user_id] = (admin_id, updated_at)
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def get(self, user_id: int) -> int | None:
+        """Возвращает ID админа или None, если диалога нет или он истёк."""
+        now = time.time()
+        cached = self._cache.get(user_id)
+        if cached is None:
+            row = await storage.fetchone(
+                "SELECT admin_id, updated_at FROM conversations WHERE user_id = ?", (user_id,),
+                op="conversation_get"
+            )
+            cached = (row[0], row[1]) if row else (None, now)
+        admin_id, updated_at = cached
+        if admin_id is not None and now - updated_at > self.ttl:
+            await self.drop(user_id)
+            return None
+        if admin_id is not None and now - updated_at > self.touch_interval:
+            # Продлеваем диалог в БД не чаще раза в touch_interval
+            await storage.execute(
+                "UPDATE conversations SET updated_at = ? WHERE user_id = ?", (now, user_id),
+                op="conversation_touch"
+            )
+            updated_at = now
+        self._remember(user_id, admin_id, updated_at)
+        return admin_id
+
+    async def set(self, user_id: int, admin_id: int):
+        now = time.time()
+        def _set(conn):
+            with conn:
+                previous = conn.execute(SQL_CONVERSATION_ADMIN, (user_id,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO conversations (user_id, admin_id, updated_at) VALUES (?, ?, ?)",
+                    (user_id, admin_id, now)
+                )
+            return previous
+        previous = await storage.run(_set, op="conversation_set")
+        if previous:
+            admin_load.closed(previous[0])
+        admin_load.opened(admin_id)
+        self._remember(user_id, admin_id, now)
+        await change_feed.publish("conversation", user_id)
+
+    async def drop(self, user_id: int):
+        cached = self._cache.get(user_id)
+        if cached is None or cached[0] is not None:
+            def _drop(conn):
+                with conn:
+                    previous = conn.execute(SQL_CONVERSATION_ADMIN, (user_id,)).fetchone()
+                    if previous:
+                        conn.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+                return previous
+            previous = await storage.run(_drop, op="conversation_drop")
+            if previous:
+                admin_load.closed(previous[0])
+                await change_feed.publish("conversation", user_id)
+        self._remember(user_id, None, time.time())
+
+    async def reassign(self, admin_id: int) -> list[tuple[int, int]]:
+        """Передаёт открытые диалоги удалённого админа наименее загруженным.
+
+        Возвращает пары (новый admin_id, user_id). Если админов не осталось,
+        диалоги закрываются.
+        """
+        rows = await storage.fetchall(
+            "SELECT user_id FROM conversations WHERE admin_id = ? AND updated_at >= ?",
+            (admin_id, time.time() - self.ttl),
+            op="conversation_list_admin"
+        )
+        moves = []
+        for (user_id,) in rows:
+            new_admin = admin_load.least_loaded()
+            if new_admin is None:
+                break
+            admin_load.opened(new_admin)
+            moves.append((new_admin, user_id))
+        def _reassign(conn):
+            with conn:
+                conn.executemany("UPDATE conversations SET admin_id = ? WHERE user_id = ?", moves)
+                conn.execute("DELETE FROM conversations WHERE admin_id = ?", (admin_id,))
+                change_feed.publish_sync(conn, "conversation", [user_id for (user_id,) in rows])
+        await storage.run(_reassign, op="conversation_reassign")
+        admin_load.conversations.pop(admin_id, None)
+        for user_id, (cached_admin, _) in list(self._cache.items()):
+            if cached_admin == admin_id:
+                del self._cache[user_id]
+        return moves
+
+    async def sync_load(self):
+        """Пересчитывает открытые диалоги админов по БД (истечения и другие процессы)."""
+        admin_load.load_conversations(await storage.fetchall(
+            "SELECT admin_id, COUNT(user_id) FROM conversations WHERE updated_at >= ? GROUP BY admin_id",
+            (time.time() - self.ttl,),
+            op="conversation_load"
+        ))
+
+    def forget(self, user_id: int):
+        """Убирает пользователя из кэша (диалог изменил другой процесс)."""
+        self._cache.pop(user_id, None)
+
+    async def prune(self):
+        """Удаляет истёкшие диалоги из БД и кэша."""
+        deadline = time.time() - self.ttl
+        removed = await storage.execute("DELETE FROM conversations WHERE updated_at < ?", (deadline,), op="conversation_prune")
+        for user_id, (admin_id, updated_at) in list(self._cache.items()):
+            if admin_id is not None and updated_at < deadline:
+                del self._cache[user_id]
+        if removed:
+            logging.info(f"Истекло диалогов: {removed}")
+
+
+SQL_CONVERSATION_ADMIN = "SELECT admin_id FROM conversations WHERE user_id = ?"
+
+conversations = ConversationStore(CONVERSATION_TTL, CONVERSATION_CACHE_SIZE)
+
+
+class MessageLinks:
+    """Связь копий сообщений в чате админа с пользователями.
+
+    Ключ - (ID чата админа, message_id копии), значение - ID пользователя.
+    Хранится в таблице message_links, свежие связи - в LRU-кэше, поэтому
+    ответ админа на любое сообщение (стикер, голосовое и т.д.) находит
+    адресата одним поиском. Связи старше ttl удаляются.
+    """
+
+    def __init__(self, ttl: float, cache_size: int):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._cache: OrderedDict[tuple[int, int], int] = OrderedDict()
+
+    def _remember(self, key: tuple[int, int], user_id: int):
+        self._cache[key] = user_id
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def add(self, admin_id: int, message_id: int, user_id: int):
+        await storage.execute(
+            "INSERT OR REPLACE INTO message_links (admin_id, message_id, user_id, created_at) "
+            "VALUES (?, ?, ?, ?)",
+            (admin_id, message_id, user_id, time.time()),
+            op="message_link_add"
+        )
+        self._remember((admin_id, message_id), user_id)
+
+    async def get(self, admin_id: int, message_id: int) -> int | None:
+        key = (admin_id, message_id)
+        user_id = self._cache.get(key)
+        if user_id is None:
+            row = await storage.fetchone(
+                "SELECT user_id FROM message_links WHERE admin_id = ? AND message_id = ?", key,
+                op="message_link_get"
+            )
+            if row is None:
+                return None
+            user_id = row[0]
+        self._remember(key, user_id)
+        return user_id
+
+    async def prune(self):
+        """Удаляет связи старше ttl (кэш вытесняет их сам по LRU)."""
+        removed = await storage.execute(
+            "DELETE FROM message_links WHERE created_at < ?", (time.time() - self.ttl,),
+            op="message_link_prune"
+        )
+        if removed:
+            logging.info(f"Удалено старых связей сообщений: {removed}")
+
+
+message_links = MessageLinks(MESSAGE_LINK_TTL, MESSAGE_LINK_CACHE_SIZE)
+
+class AdminRelay:
+    """Пересылка сообщений пользователей админам.
+
+    У каждого админа своя очередь и своя задача-отправитель. Хэндлер только
+    ставит сообщение в очередь и отпускает воркер UpdateQueue, а ожидание
+    лимита чата админа и сама отправка идут здесь - занятый админ больше не
+    задерживает чаты, попавшие в тот же воркер. Отправитель у админа один,
+    поэтому сообщения приходят по порядку и копия не оказывается под
+    заголовком другого пользователя.
+
+    Заголовок "Сообщение от ..." отправляется, только когда собеседник админа
+    меняется. Порядок сообщений в чате админа из разных процессов ничем не
+    упорядочен, поэтому при нескольких процессах заголовок идёт всегда.
+    """
+
+    def __init__(self, always_header: bool):
+        self.always_header = always_header
+        # admin_id -> пользователь, чьё сообщение в чате админа последнее
+        self._last_user: dict[int, int] = {}
+        # admin_id -> (сообщение, когда принято)
+        self._queues: dict[int, deque[tuple[Message, float]]] = {}
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def submit(self, admin_id: int, message: Message):
+        self._queues.setdefault(admin_id, deque()).append((message, time.perf_counter()))
+        if admin_id not in self._tasks:
+            self._tasks[admin_id] = asyncio.create_task(self._run(admin_id))
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def forget(self, admin_id: int):
+        self._last_user.pop(admin_id, None)
+
+    async def _run(self, admin_id: int):
+        # Задача унаследовала контекст хэндлера: её отправки - не этапы его обновления
+        UPDATE_TRACE.set(None)
+        queue = self._queues[admin_id]
+        try:
+            while queue:
+                message, accepted = queue.popleft()
+                try:
+                    await self._relay(admin_id, message)
+                except Exception as e:
+                    logging.error(f"Ошибка пересылки админу {admin_id}: {e}")
+                metrics.observe("bot_relay_seconds", time.perf_counter() - accepted)
+        finally:
+            del self._tasks[admin_id]
+            if not queue:
+                del self._queues[admin_id]
+
+    async def _relay(self, admin_id: int, message: Message):
+        user_id = message.from_user.id
+        try:
+            # Заголовок нужен, только если админу до этого писал другой пользователь
+            if self.always_header or self._last_user.get(admin_id) != user_id:
+                header = await bot.send_message(admin_id, f"📩 Сообщение от {message.from_user.full_name} (ID: {user_id})")
+                await message_links.add(admin_id, header.message_id, user_id)
+                self._last_user[admin_id] = user_id
+
+            # Копируем сообщение без изменений (работает для всех типов, включая стикеры)
+            copy = await message.copy_to(chat_id=admin_id)
+            await message_links.add(admin_id, copy.message_id, user_id)
+            archive.add(user_id, admin_id, "in", message)
+            admin_load.message(admin_id)
+            stats_count_relayed()
+
+        except TelegramForbiddenError:
+            logging.warning(f"Админ {admin_id} заблокировал бота. Удаляем его.")
+            # Этому пользователю предлагаем выбрать заново, остальных передаст db_del_admin
+            await conversations.drop(user_id)
+            await db_del_admin(admin_id)
+            await message.answer("❗️Не удалось отправить. Админ больше недоступен. "
+                                 "Попробуйте /start и выберите другого админа.")
+        except Exception as e:
+            logging.error(f"Ошибка при пересылке админу {admin_id}: {e}")
+            await message.answer("❗️Не удалось отправить. Попробуйте /start и выберите другого админа.")
+            await conversations.drop(user_id)
+
+    async def stop(self, timeout: float = 10):
+        """Дожидается отправки уже принятых сообщений."""
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logging.warning(f"Не дождались пересылки админам, в очереди осталось {self.depth()}")
+
+
+admin_relay = AdminRelay(MULTIPROCESS)
+metrics.histogram("bot_relay_seconds", "От приёма сообщения пользователя до его копии у админа")
+metrics.gauge("bot_relay_queue_depth", "Сообщения в очередях пересылки админам", admin_relay.depth)
+
+
+# --- ================================== ---
+# ---      БЛОК: АРХИВ ПЕРЕПИСКИ         ---
+# --- ================================== ---
+
+class MessageArchive(BatchWriter):
+    """Архив пересланных сообщений (пользователь -> админ и обратно).
+
+    Сообщения копятся в памяти, в таблицу messages их пишет пачками
+    BatchWriter. Полнотекстовый индекс
+    messages_fts (FTS5, external content) обновляет триггер на вставку.
+    Выдача постраничная: следующая страница - всё, что старше последнего
+    показанного id, поэтому любая страница читается по индексу.
+    """
+
+    PAGE_SIZE = 10
+    name = "архива сообщений"
+    op = "archive_flush"
+
+    def _empty(self) -> list[tuple]:
+        return []
+
+    def _requeue(self, batch: list[tuple]):
+        self.pending[:0] = batch
+
+    def add(self, user_id: int, admin_id: int, direction: str, message: Message):
+        """direction: "in" - от пользователя админу, "out" - ответ админа."""
+        text = message.text or message.caption or f"[{message.content_type}]"
+        self.pending.append((user_id, admin_id, direction, text, time.time()))
+        self._added()
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, batch: list[tuple]):
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (user_id, admin_id, direction, text, created_at) VALUES (?, ?, ?, ?, ?)",
+                batch
+            )
+
+    @staticmethod
+    def _match_expression(query: str) -> str:
+        """Слова запроса как фразы FTS5: спецсимволы пользователя не ломают синтаксис."""
+        return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+    async def search(self, query: str, before: int | None = None) -> list[tuple]:
+        """Страница совпадений, новые первыми: (id, user_id, admin_id, direction, created_at, фрагмент)."""
+        await self.flush()
+        return await storage.fetchall(
+            "SELECT m.id, m.user_id, m.admin_id, m.direction, m.created_at, "
+            "snippet(messages_fts, 0, '«', '»', '…', 16) "
+            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            "WHERE messages_fts MATCH ? AND messages_fts.rowid < ? "
+            "ORDER BY messages_fts.rowid DESC LIMIT ?",
+            (self._match_expression(query), before or sys.maxsize, self.PAGE_SIZE + 1),
+            op="archive_search"
+        )
+
+    async def history(self, user_id: int, before: int | None = None) -> list[tuple]:
+        """Страница переписки с пользователем, новые сообщения первыми."""
+        await self.flush()
+        return await storage.fetchall(
+            "SELECT id, user_id, admin_id, direction, created_at, text FROM messages "
+            "WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (user_id, before or sys.maxsize, self.PAGE_SIZE + 1),
+            op="archive_history"
+        )
+
+
+archive = MessageArchive(ARCHIVE_INTERVAL, ARCHIVE_MAX_PENDING)
+
+
+# --- ================================== ---
+# ---   БЛОК: ИСХОДЯЩИЕ СООБЩЕНИЯ        ---
+# --- ================================== ---
+
+class TokenBucket:
+    """Общий для всех отправителей лимит скорости (token bucket)."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = 0.0
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        """Ждёт, пока появится токен, и забирает его."""
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.updated:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (ответ Telegram с retry_after)."""
+        now = asyncio.get_running_loop().time()
+        self.paused_until = max(self.paused_until, now + seconds)
+        self.tokens = 0
+
+
+# Полоса, в которую попадают запросы текущей задачи. Рассылки выставляют
+# "broadcast", всё остальное (ответы в диалогах) идёт в "interactive"
+SEND_LANE: ContextVar[str] = ContextVar("SEND_LANE", default="interactive")
+
+
+class OutboundRequest:
+    __slots__ = ("chat_id", "lane", "call", "future", "enqueued_at", "attempts")
+
+    def __init__(self, chat_id, lane: str, call, future: asyncio.Future, enqueued_at: float):
+        self.chat_id = chat_id
+        self.lane = lane
+        self.call = call
+        self.future = future
+        self.enqueued_at = enqueued_at
+        self.attempts = 0
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Планировщик всех исходящих запросов к Bot API, адресованных в чат.
+
+    Подключается как middleware сессии бота, поэтому через него проходят и
+    ответы хэндлеров, и рассылки. Соблюдает общий лимит и лимит на чат,
+    полоса "interactive" всегда обслуживается раньше "broadcast", а
+    retry_after от Telegram приостанавливает отправку для всех.
+    """
+
+    LANES = ("interactive", "broadcast")
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, max_chats: int = 10_000):
+        self.bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        # chat_id -> (токены, время обновления)
+        self._chats: dict = {}
+        self._lanes: dict[str, deque[OutboundRequest]] = {lane: deque() for lane in self.LANES}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+        self.sent = {lane: 0 for lane in self.LANES}
+        self.wait_total = {lane: 0.0 for lane in self.LANES}
+        self.wait_max = {lane: 0.0 for lane in self.LANES}
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # Запросы не в чат (answerCallbackQuery, setWebhook, ...) не лимитируются
+            started = time.perf_counter()
+            try:
+                return await self._request(lambda: make_request(bot, method), "direct")
+            finally:
+                trace_stage(f"api {type(method).__name__}", time.perf_counter() - started)
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        lane = SEND_LANE.get()
+        request = OutboundRequest(chat_id, lane, lambda: make_request(bot, method), loop.create_future(), loop.time())
+        self._lanes[lane].append(request)
+        self._wakeup.set()
+        try:
+            return await request.future
+        finally:
+            trace_stage(f"api {type(method).__name__}", loop.time() - request.enqueued_at)
+
+    def _chat_ready(self, chat_id, now: float) -> float:
+        """0, если в чат можно отправить сейчас, иначе сколько ждать."""
+        tokens, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.chat_rate
+
+    def _take_chat_token(self, chat_id, now: float):
+        tokens, updated = self._chats.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+        self._chats[chat_id] = (tokens - 1, now)
+        if len(self._chats) > self.max_chats:
+            # Забываем чаты, чьи лимиты уже полностью восстановились
+            full = now - self.chat_burst / self.chat_rate
+            self._chats = {key: value for key, value in self._chats.items() if value[1] > full}
+
+    def _next_request(self, now: float) -> tuple[OutboundRequest | None, float | None]:
+        """Первый запрос старшей полосы, чей чат не упёрся в лимит."""
+        delay = None
+        for lane in self.LANES:
+            queue = self._lanes[lane]
+            for index, request in enumerate(queue):
+                if request.future.done():
+                    # Вызвавшая задача отменена - отправлять уже некому
+                    del queue[index]
+                    return None, 0.0
+                wait = self._chat_ready(request.chat_id, now)
+                if not wait:
+                    del queue[index]
+                    return request, None
+                delay = wait if delay is None else min(delay, wait)
+        return None, delay
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            request, delay = self._next_request(loop.time())
+            if request is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self.bucket.acquire()
+            now = loop.time()
+            self._take_chat_token(request.chat_id, now)
+            if not request.attempts:
+                waited = now - request.enqueued_at
+                self.sent[request.lane] += 1
+                self.wait_total[request.lane] += waited
+                self.wait_max[request.lane] = max(self.wait_max[request.lane], waited)
+                metrics.observe("bot_outbound_wait_seconds", waited, lane=request.lane)
+            task = asyncio.create_task(self._execute(request))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    @staticmethod
+    async def _request(call, lane: str):
+        started = time.perf_counter()
+        try:
+            return await call()
+        except Exception as e:
+            metrics.inc("bot_outbound_errors_total", error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_outbound_request_seconds", time.perf_counter() - started, lane=lane)
+
+    async def _execute(self, request: OutboundRequest):
+        request.attempts += 1
+        try:
+            result = await self._request(request.call, request.lane)
+        except TelegramRetryAfter as e:
+            if request.attempts >= self.MAX_ATTEMPTS:
+                if not request.future.done():
+                    request.future.set_exception(e)
+                return
+            logging.warning(f"Лимит Telegram (чат {request.chat_id}), пауза {e.retry_after} с")
+            self.bucket.pause(e.retry_after)
+            self._lanes[request.lane].appendleft(request)
+            self._wakeup.set()
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
+
+    def stats(self) -> dict:
+        """Очередь и среднее/максимальное ожидание (сек) по полосам."""
+        return {
+            lane: {
+                "queued": len(self._lanes[lane]),
+                "sent": self.sent[lane],
+                "avg_wait": self.wait_total[lane] / self.sent[lane] if self.sent[lane] else 0.0,
+                "max_wait": self.wait_max[lane],
+            }
+            for lane in self.LANES
+        }
+
+    async def stop(self):
+        """Останавливает диспетчер, дождавшись уже отправляемых запросов."""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+        for queue in self._lanes.values():
+            while queue:
+                request = queue.popleft()
+                if not request.future.done():
+                    request.future.set_exception(RuntimeError("Бот останавливается"))
+
+
+outbound = OutboundScheduler(SEND_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST)
+bot.session.middleware(outbound)
+
+
+# --- ================================== ---
+# ---         БЛОК: РАССЫЛКИ             ---
+# --- ================================== ---
+
+SQL_BROADCAST_SELECT = (
+    "SELECT job_id, owner_id, text, from_chat_id, message_id, caption, status, cursor, "
+    "total, sent, blocked, failed, segment, media, start_at, finish_at"
+)
+SQL_BROADCAST_PROGRESS = "UPDATE broadcasts SET cursor = ?, sent = ?, blocked = ?, failed = ? WHERE job_id = ?"
+SQL_BROADCAST_SAVE = (
+    "UPDATE broadcasts SET status = ?, cursor = ?, sent = ?, blocked = ?, failed = ? WHERE job_id = ?"
+)
+
+
+class Audience:
+    """Получатели рассылки: активные пользователи, при желании - их сегмент.
+
+    Пользователи читаются порциями по возрастанию user_id (keyset-пагинация
+    по частичному индексу idx_users_active), поэтому в памяти одновременно
+    находится только одна порция ID. Границы сегмента хранятся в абсолютном
+    времени, чтобы после перезапуска рассылка шла по тому же сегменту.
+    """
+
+    # Параметры сегмента в команде /broadcast: ключ=число
+    OPTIONS = {
+        "seen": "были активны за последние N дней",
+        "new": "пришли за последние N дней",
+        "old": "пришли раньше, чем N дней назад",
+        "sample": "случайные N% пользователей",
+    }
+
+    def __init__(self, seen_after: float | None = None, joined_after: float | None = None,
+                 joined_before: float | None = None, sample_percent: int | None = None):
+        self.seen_after = seen_after
+        self.joined_after = joined_after
+        self.joined_before = joined_before
+        self.sample_percent = sample_percent
+
+    @classmethod
+    def parse(cls, text: str, audience: "Audience | None" = None) -> tuple["Audience", str]:
+        """Забирает ведущие параметры сегмента (seen=7 sample=10 ...) и возвращает остаток текста."""
+        audience = audience or cls()
+        now = time.time()
+        parts = text.split(maxsplit=1)
+        while parts and "=" in parts[0]:
+            key, _, value = parts[0].partition("=")
+            if key not in cls.OPTIONS:
+                break
+            if not value.isdigit():
+                # Опечатка не должна превратиться в рассылку всем с "seen=7d" в тексте
+                raise ValueError(f"`{parts[0]}`: ожидается {key}=N, {cls.OPTIONS[key]}")
+            number = int(value)
+            if key == "seen":
+                audience.seen_after = now - number * 86400
+            elif key == "new":
+                audience.joined_after = now - number * 86400
+            elif key == "old":
+                audience.joined_before = now - number * 86400
+            else:
+                audience.sample_percent = min(number, 100)
+            parts = parts[1].split(maxsplit=1) if len(parts) > 1 else []
+        return audience, " ".join(parts)
+
+    @classmethod
+    def from_json(cls, data: str | None) -> "Audience":
+        return cls(**json.loads(data)) if data else cls()
+
+    def to_json(self) -> str | None:
+        data = {key: value for key, value in vars(self).items() if value is not None}
+        return json.dumps(data) if data else None
+
+    def describe(self) -> str:
+        parts = []
+        if self.seen_after is not None:
+            parts.append(f"активны с {time.strftime('%d.%m.%Y', time.localtime(self.seen_after))}")
+        if self.joined_after is not None:
+            parts.append(f"пришли после {time.strftime('%d.%m.%Y', time.localtime(self.joined_after))}")
+        if self.joined_before is not None:
+            parts.append(f"пришли до {time.strftime('%d.%m.%Y', time.localtime(self.joined_before))}")
+        if self.sample_percent is not None:
+            parts.append(f"выборка {self.sample_percent}%")
+        return ", ".join(parts) or "все активные"
+
+    def _where(self) -> tuple[str, list]:
+        # Первые два условия совпадают с условием частичного индекса idx_users_active
+        clauses = ["is_blocked_bot = 0", "is_banned = 0"]
+        params = []
+        if self.seen_after is not None:
+            clauses.append("last_seen >= ?")
+            params.append(self.seen_after)
+        if self.joined_after is not None:
+            clauses.append("joined_at >= ?")
+            params.append(self.joined_after)
+        if self.joined_before is not None:
+            clauses.append("joined_at < ?")
+            params.append(self.joined_before)
+        if self.sample_percent is not None:
+            clauses.append("user_id % 100 < ?")
+            params.append(self.sample_percent)
+        return " AND ".join(clauses), params
+
+    def count_sync(self, conn: sqlite3.Connection) -> int:
+        where, params = self._where()
+        return conn.execute(f"SELECT COUNT(user_id) FROM users WHERE {where}", params).fetchone()[0]
+
+    async def chunks(self, after: int = 0, size: int = 200):
+        """Асинхронно выдаёт списки ID пользователей с user_id > after порциями по size."""
+        where, params = self._where()
+        sql = f"SELECT user_id FROM users WHERE {where} AND user_id > ? ORDER BY user_id LIMIT ?"
+        while True:
+            # Блокировки и баны из журнала должны попасть в выборку
+            await user_journal.flush()
+            rows = await storage.fetchall(sql, (*params, after, size), op="audience_chunk")
+            if not rows:
+                return
+            chunk = [row[0] for row in rows]
+            yield chunk
+            after = chunk[-1]
+
+
+CLOCK_PATTERN = re.compile(r"(\d{1,2}:\d{2})(.*)")
+TZ_OFFSET_PATTERN = re.compile(r"(?:UTC|GMT)?([+-])(\d{1,2})(?::?(\d{2}))?")
+
+
+def parse_timezone(value: str) -> tzinfo:
+    """Часовой пояс из смещения (+03:00, UTC+3) или имени (Europe/Moscow)."""
+    if value.upper() in ("UTC", "GMT", "Z"):
+        return timezone.utc
+    match = TZ_OFFSET_PATTERN.fullmatch(value.upper())
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+        if offset >= timedelta(hours=24):
+            raise ValueError(f"неверное смещение часового пояса: {value}")
+        return timezone(-offset if sign == "-" else offset)
+    try:
+        return ZoneInfo(value)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"неизвестный часовой пояс: {value}") from None
+
+
+SCHEDULE_TZ = parse_timezone(BROADCAST_TZ)
+
+
+def format_when(timestamp: float) -> str:
+    """Время рассылки в поясе BROADCAST_TZ с его названием, например "18.10 18:00 MSK"."""
+    local = datetime.fromtimestamp(timestamp, SCHEDULE_TZ)
+    return f"{local:%d.%m %H:%M} {local.tzname()}"
+
+
+class BroadcastSchedule:
+    """Когда начать рассылку и на сколько её растянуть."""
+
+    # Параметры расписания в команде /broadcast
+    OPTIONS = {
+        "at": f"начать в ЧЧ:ММ по {BROADCAST_TZ} (сегодня или завтра), другой пояс - суффиксом: 18:00+03:00",
+        "in": "начать через N (30m, 2h, 1d)",
+        "over": "растянуть отправку на N (например 2h)",
+    }
+    UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+    def __init__(self, start_at: float | None = None, spread: float | None = None):
+        self.start_at = start_at
+        self.spread = spread
+
+    @classmethod
+    def _duration(cls, value: str) -> float | None:
+        number, unit = value[:-1], value[-1:]
+        if unit not in cls.UNITS or not number.isdigit():
+            return None
+        return int(number) * cls.UNITS[unit]
+
+    @staticmethod
+    def _clock(value: str, now: float) -> float | None:
+        """Ближайший момент ЧЧ:ММ в поясе BROADCAST_TZ или в указанном после времени (18:00+03:00)."""
+        match = CLOCK_PATTERN.fullmatch(value)
+        if not match:
+            return None
+        clock, zone = match.groups()
+        try:
+            parsed = time.strptime(clock, "%H:%M")
+            tz = parse_timezone(zone) if zone else SCHEDULE_TZ
+        except ValueError:
+            return None
+        at = datetime.fromtimestamp(now, tz).replace(hour=parsed.tm_hour, minute=parsed.tm_min, second=0, microsecond=0)
+        if at.timestamp() <= now:
+            at += timedelta(days=1)
+        return at.timestamp()
+
+    @classmethod
+    def parse(cls, text: str, schedule: "BroadcastSchedule | None" = None) -> tuple["BroadcastSchedule", str]:
+        """Забирает ведущие параметры расписания (at=18:30 over=2h ...) и возвращает остаток текста."""
+        schedule = schedule or cls()
+        now = time.time()
+        parts = text.split(maxsplit=1)
+        while parts and "=" in parts[0]:
+            key, _, value = parts[0].partition("=")
+            if key not in cls.OPTIONS:
+                break
+            if key == "at":
+                start_at = cls._clock(value, now)
+            else:
+                duration = cls._duration(value)
+                start_at = now + duration if duration else None
+            if start_at is None:
+                # Опечатка не должна превратиться в немедленную рассылку всем
+                raise ValueError(f"`{parts[0]}`: {cls.OPTIONS[key]}")
+            if key == "over":
+                schedule.spread = duration
+            else:
+                schedule.start_at = start_at
+            parts = parts[1].split(maxsplit=1) if len(parts) > 1 else []
+        return schedule, " ".join(parts)
+
+    def finish_at(self) -> float | None:
+        if not self.spread:
+            return None
+        return max(self.start_at or 0, time.time()) + self.spread
+
+
+def parse_broadcast_options(text: str) -> tuple[Audience, BroadcastSchedule, str]:
+    """Разбирает ведущие параметры сегмента и расписания в любом порядке.
+
+    ValueError - известный параметр с неверным значением.
+    """
+    audience, schedule = Audience(), BroadcastSchedule()
+    while True:
+        audience, rest = Audience.parse(text, audience)
+        schedule, rest = BroadcastSchedule.parse(rest, schedule)
+        if rest == text:
+            return audience, schedule, rest
+        text = rest
+
+
+class AlbumCollector(BaseMiddleware):
+    """Части альбомов (media group), присланных владельцами.
+
+    Telegram доставляет альбом отдельными сообщениями с общим media_group_id,
+    и при нескольких процессах части попадают в разные процессы. Поэтому
+    outer middleware пишет каждую часть в таблицу media_group_parts, а
+    рассылка собирает оттуда альбом целиком - и сразу после отправки, и по
+    ответу на альбом командой /broadcast. Сборка идёт в фоновой задаче:
+    части одного чата обрабатывает один воркер UpdateQueue, и ожидание в
+    хэндлере задержало бы за собой остальные части альбома.
+    """
+
+    SETTLE = 0.5
+    MAX_WAIT = 5.0
+    TTL = 86400
+
+    def __init__(self):
+        # media_group_id -> фоновая сборка альбома для рассылки
+        self._assembling: dict[str, asyncio.Task] = {}
+        # media_group_id -> (альбом рассылки или нет, когда узнали); хранится TTL
+        self._known: dict[str, tuple[bool, float]] = {}
+
+    @staticmethod
+    def item(message: Message) -> dict | None:
+        """Файл сообщения как элемент рассылки: тип, file_id и подпись."""
+        for kind in ("photo", "video", "document", "audio"):
+            media = getattr(message, kind)
+            if media:
+                file_id = media[-1].file_id if kind == "photo" else media.file_id
+                return {"type": kind, "media": file_id, "caption": message.caption}
+        return None
+
+    async def __call__(self, handler, event, data):
+        if event.media_group_id and event.from_user and event.from_user.id in BOT_OWNERS:
+            item = self.item(event)
+            if item:
+                await storage.execute(
+                    "INSERT OR IGNORE INTO media_group_parts (media_group_id, message_id, item, created_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (event.media_group_id, event.message_id, json.dumps(item), time.time()),
+                    op="album_part_add"
+                )
+        return await handler(event, data)
+
+    async def collect(self, media_group_id: str) -> list[dict]:
+        """Ждёт, пока части альбома перестанут приходить, и возвращает их по порядку."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.MAX_WAIT
+        count = -1
+        while True:
+            rows = await storage.fetchall(
+                "SELECT item FROM media_group_parts WHERE media_group_id = ? ORDER BY message_id",
+                (media_group_id,),
+                op="album_collect"
+            )
+            if len(rows) == count or loop.time() >= deadline:
+                return [json.loads(row[0]) for row in rows]
+            count = len(rows)
+            await asyncio.sleep(self.SETTLE)
+
+    def assemble(self, media_group_id: str, build) -> bool:
+        """Собирает альбом в фоне и передаёт части в build(media).
+
+        False - этот альбом уже собирается.
+        """
+        if media_group_id in self._assembling:
+            return False
+        task = asyncio.create_task(self._assemble(media_group_id, build))
+        self._assembling[media_group_id] = task
+        self._known[media_group_id] = (True, time.time())
+        task.add_done_callback(lambda _: self._assembling.pop(media_group_id, None))
+        return True
+
+    async def _assemble(self, media_group_id: str, build):
+        try:
+            await build(await self.collect(media_group_id))
+        except Exception as e:
+            logging.error(f"Ошибка сборки альбома {media_group_id}: {e}")
+
+    async def stop(self):
+        """Дожидается альбомов, которые уже собираются: их части к этому моменту получены."""
+        tasks = list(self._assembling.values())
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=self.MAX_WAIT + self.SETTLE * 2)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        if pending:
+            logging.warning(f"Не дождались сборки {len(pending)} альбомов при остановке")
+
+    async def is_broadcast(self, media_group_id: str) -> bool:
+        """Альбом рассылки: собирается здесь или в БД уже есть часть с командой.
+
+        Не ждёт остальных частей - команда приходит в подписи первой части.
+        В БД спрашивает один раз на альбом, дальше ответ берётся из памяти.
+        """
+        known = self._known.get(media_group_id)
+        if known:
+            return known[0]
+        broadcast = await storage.fetchone(
+            "SELECT 1 FROM media_group_parts WHERE media_group_id = ? "
+            "AND json_extract(item, '$.caption') LIKE '/broadcast%' LIMIT 1",
+            (media_group_id,),
+            op="album_is_broadcast"
+        ) is not None
+        self._known[media_group_id] = (broadcast, time.time())
+        return broadcast
+
+    async def prune(self):
+        await storage.execute("DELETE FROM media_group_parts WHERE created_at < ?", (time.time() - self.TTL,), op="album_prune")
+
+    async def forget_old(self):
+        """Забывает старые альбомы (в каждом процессе: память у каждого своя)."""
+        expired = time.time() - self.TTL
+        for media_group_id in [key for key, (_, seen) in self._known.items() if seen < expired]:
+            del self._known[media_group_id]
+
+
+album_collector = AlbumCollector()
+dp.message.outer_middleware(album_collector)
+
+
+class UploadCache:
+    """file_id файлов с диска сервера, уже загруженных в Telegram.
+
+    Файл загружается один раз - отправкой владельцу, запустившему рассылку
+    (заодно это предпросмотр), - а получателям уходит по file_id, так что
+    трафик и время загрузки не зависят от размера аудитории. Запись
+    привязана к размеру и времени изменения файла: изменённый файл
+    загружается заново.
+    """
+
+    KINDS = {
+        ".jpg": "photo", ".jpeg": "photo", ".png": "photo",
+        ".mp4": "video", ".mov": "video",
+        ".mp3": "audio", ".m4a": "audio",
+    }
+
+    def __init__(self, directory: str):
+        self.directory = os.path.realpath(directory)
+
+    def resolve(self, name: str) -> str:
+        """Полный путь к файлу; за пределы папки рассылок выйти нельзя."""
+        path = os.path.realpath(os.path.join(self.directory, name))
+        if not path.startswith(self.directory + os.sep):
+            raise ValueError(f"файл должен лежать в папке {self.directory}")
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"файл {name} не найден")
+        return path
+
+    def listing(self, limit: int = 20) -> list[str]:
+        try:
+            return sorted(os.listdir(self.directory))[:limit]
+        except OSError:
+            return []
+
+    async def get(self, name: str, chat_id: int) -> dict:
+        """Элемент рассылки для файла; при первом обращении файл загружается в чат chat_id."""
+        path = self.resolve(name)
+        stat = os.stat(path)
+        row = await storage.fetchone(
+            "SELECT kind, file_id FROM uploaded_files WHERE path = ? AND size = ? AND mtime = ?",
+            (path, stat.st_size, stat.st_mtime),
+            op="upload_get"
+        )
+        if row is None:
+            kind = self.KINDS.get(os.path.splitext(path)[1].lower(), "document")
+            message = await getattr(bot, f"send_{kind}")(chat_id, FSInputFile(path))
+            row = kind, AlbumCollector.item(message)["media"]
+            await storage.execute(
+                "INSERT OR REPLACE INTO uploaded_files (path, size, mtime, kind, file_id, uploaded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (path, stat.st_size, stat.st_mtime, *row, time.time()),
+                op="upload_save"
+            )
+            logging.info(f"Файл {path} загружен в Telegram ({stat.st_size} байт)")
+        return {"type": row[0], "media": row[1], "caption": None}
+
+
+upload_cache = UploadCache(BROADCAST_FILES_DIR)
+
+
+class BroadcastJob:
+    """Рассылка и её прогресс. cursor - последний обработанный user_id."""
+
+    INPUT_MEDIA = {
+        "photo": InputMediaPhoto, "video": InputMediaVideo,
+        "document": InputMediaDocument, "audio": InputMediaAudio,
+    }
+
+    def __init__(self, job_id: int, owner_id: int, text: str | None = None,
+                 from_chat_id: int | None = None, message_id: int | None = None,
+                 caption: str | None = None, status: str = "running", cursor: int = 0,
+                 total: int = 0, sent: int = 0, blocked: int = 0, failed: int = 0,
+                 segment: str | None = None, media: str | None = None,
+                 start_at: float | None = None, finish_at: float | None = None):
+        self.job_id = job_id
+        self.owner_id = owner_id
+        self.text = text
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.caption = caption
+        self.status = status
+        self.cursor = cursor
+        self.total = total
+        self.sent = sent
+        self.blocked = blocked
+        self.failed = failed
+        self.audience = Audience.from_json(segment)
+        self.media: list[dict] | None = json.loads(media) if media else None
+        # Альбом собирается один раз и переиспользуется для всех получателей
+        self.input_media = [
+            self.INPUT_MEDIA[item["type"]](media=item["media"], caption=item.get("caption"), parse_mode="Markdown")
+            for item in self.media
+        ] if self.media and len(self.media) > 1 else None
+        self.start_at = start_at
+        # Если задано, отправка растягивается так, чтобы закончиться к этому времени
+        self.finish_at = finish_at
+        self.pacer: TokenBucket | None = None
+        self.resumed = asyncio.Event()
+        if status == "running":
+            self.resumed.set()
+        self.task: asyncio.Task | None = None
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    def progress_text(self) -> str:
+        if self.status == "scheduled":
+            return f"#{self.job_id} [scheduled] начнётся {self.when(self.start_at)}, сейчас получателей {self.total}"
+        percent = self.done / self.total if self.total else 1.0
+        text = (
+            f"#{self.job_id} [{self.status}] {self.done}/{self.total} ({percent:.0%}): "
+            f"отправлено {self.sent}, блокировок {self.blocked}, ошибок {self.failed}"
+        )
+        if self.finish_at:
+            text += f", растянута до {self.when(self.finish_at)}"
+        return text
+
+    @staticmethod
+    def when(timestamp: float) -> str:
+        return format_when(timestamp)
+
+
+class BroadcastEngine:
+    """Рассылки пулом отправителей.
+
+    Скорость ограничивает OutboundScheduler: запросы рассылки идут в полосе
+    "broadcast" и уступают ответам в диалогах.
+
+    Получатели (Audience) читаются порциями по возрастанию user_id. После каждой порции
+    курсор и счётчики сохраняются в таблицу broadcasts, поэтому после
+    перезапуска рассылка продолжается с места остановки (повторно может уйти
+    только незавершённая порция).
+    """
+
+    def __init__(self, workers: int, chunk_size: int = 200):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.jobs: dict[int, BroadcastJob] = {}
+
+    async def create(self, owner_id: int, audience: Audience, text: str | None = None,
+                     from_chat_id: int | None = None, message_id: int | None = None,
+                     caption: str | None = None, media: list[dict] | None = None,
+                     schedule: BroadcastSchedule | None = None) -> BroadcastJob | None:
+        """Сохраняет новую рассылку в БД и запускает её (или ставит в расписание).
+
+        None - в аудитории никого нет, рассылка не создана. Аудитория
+        считается один раз, в той же транзакции, что и вставка.
+        """
+        segment = audience.to_json()
+        media = json.dumps(media) if media else None
+        schedule = schedule or BroadcastSchedule()
+        start_at, finish_at = schedule.start_at, schedule.finish_at()
+        status = "scheduled" if start_at and start_at > time.time() else "running"
+        await user_journal.flush()
+        def _create(conn):
+            with conn:
+                total = audience.count_sync(conn)
+                if not total:
+                    return None, 0
+                cursor = conn.execute(
+                    "INSERT INTO broadcasts (owner_id, text, from_chat_id, message_id, caption, total, segment, media, "
+                    "status, start_at, finish_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (owner_id, text, from_chat_id, message_id, caption, total, segment, media,
+                     status, start_at, finish_at)
+                )
+                return cursor.lastrowid, total
+        job_id, total = await storage.run(_create, op="broadcast_create")
+        if job_id is None:
+            return None
+        job = BroadcastJob(job_id, owner_id, text, from_chat_id, message_id, caption, status=status,
+                           total=total, segment=segment, media=media, start_at=start_at, finish_at=finish_at)
+        if status == "scheduled":
+            broadcast_scheduler.add(start_at, job_id)
+        else:
+            await self._start(job)
+        return job
+
+    async def start_scheduled(self, job_id: int):
+        """Запускает отложенную рассылку, если её не отменили и не запустил другой процесс."""
+        await user_journal.flush()
+        def _claim(conn):
+            with conn:
+                claimed = conn.execute(
+                    "UPDATE broadcasts SET status = 'running', runner = ? WHERE job_id = ? AND status = 'scheduled'",
+                    (self.runner, job_id)
+                ).rowcount
+                if not claimed:
+                    return None
+                row = conn.execute(SQL_BROADCAST_SELECT + " FROM broadcasts WHERE job_id = ?", (job_id,)).fetchone()
+                # Аудитория могла измениться с момента планирования
+                total = Audience.from_json(row[12]).count_sync(conn)
+                conn.execute("UPDATE broadcasts SET total = ? WHERE job_id = ?", (total, job_id))
+                return row[:8] + (total,) + row[9:]
+        row = await storage.run(_claim, op="broadcast_claim_scheduled")
+        if row is not None:
+            logging.info(f"Запуск отложенной рассылки #{job_id}")
+            await self._start(BroadcastJob(*row))
+
+    async def resume(self):
+        """Поднимает незавершённые рассылки из БД (вызывается при запуске).
+
+        Процесс забирает рассылки, которые выполнял он сам до падения, а
+        процесс 0 - ещё и все рассылки предыдущего запуска бота.
+        """
+        rows = await storage.fetchall(
+            SQL_BROADCAST_SELECT + ", runner FROM broadcasts WHERE status IN ('running', 'paused')",
+            op="broadcast_resume"
+        )
+        resumed = 0
+        for *row, runner in rows:
+            run_id = (runner or "").rpartition(":")[0]
+            if runner == self.runner or (WORKER_ID == 0 and run_id != RUN_ID):
+                await self._start(BroadcastJob(*row))
+                resumed += 1
+        if resumed:
+            logging.info(f"Возобновлено рассылок: {resumed}")
+
+    @property
+    def runner(self) -> str:
+        return f"{RUN_ID}:{WORKER_ID}"
+
+    async def _start(self, job: BroadcastJob):
+        # Отмечаем, какой процесс выполняет рассылку (см. resume)
+        await storage.execute("UPDATE broadcasts SET runner = ? WHERE job_id = ?", (self.runner, job.job_id), op="broadcast_runner")
+        self.jobs[job.job_id] = job
+        job.task = asyncio.create_task(self._run(job))
+
+    async def pause(self, job_id: int) -> BroadcastJob | None:
+        return await self._set_status(job_id, "paused", ("running",))
+
+    async def unpause(self, job_id: int) -> BroadcastJob | None:
+        return await self._set_status(job_id, "running", ("paused",))
+
+    async def cancel(self, job_id: int) -> BroadcastJob | None:
+        return await self._set_status(job_id, "cancelled", ("running", "paused", "scheduled"))
+
+    async def active_jobs(self) -> list[BroadcastJob]:
+        """Незавершённые рассылки всех процессов (свои - с живыми счётчиками)."""
+        rows = await storage.fetchall(
+            SQL_BROADCAST_SELECT + " FROM broadcasts WHERE status IN ('running', 'paused', 'scheduled') ORDER BY job_id",
+            op="broadcast_active"
+        )
+        return [self.jobs.get(row[0]) or BroadcastJob(*row) for row in rows]
+
+    @staticmethod
+    def _apply_status(job: BroadcastJob, status: str):
+        job.status = status
+        if status == "paused":
+            job.resumed.clear()
+        else:
+            job.resumed.set()
+
+    async def _set_status(self, job_id: int, status: str, allowed: tuple[str, ...]) -> BroadcastJob | None:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            if job.status in allowed:
+                self._apply_status(job, status)
+                await self._save(job)
+            return job
+        # Рассылка отложена или её выполняет другой процесс: они увидят новый статус в БД
+        placeholders = ",".join("?" * len(allowed))
+        await storage.execute(
+            f"UPDATE broadcasts SET status = ? WHERE job_id = ? AND status IN ({placeholders})",
+            (status, job_id, *allowed),
+            op="broadcast_set_status"
+        )
+        row = await storage.fetchone(SQL_BROADCAST_SELECT + " FROM broadcasts WHERE job_id = ?", (job_id,), op="broadcast_get")
+        return BroadcastJob(*row) if row else None
+
+    async def _sync_status(self, job: BroadcastJob):
+        """Подхватывает статус, выставленный другим процессом."""
+        if MULTIPROCESS:
+            row = await storage.fetchone("SELECT status FROM broadcasts WHERE job_id = ?", (job.job_id,), op="broadcast_status")
+            if row and row[0] != job.status:
+                self._apply_status(job, row[0])
+
+    async def _wait_resumed(self, job: BroadcastJob):
+        """Ждёт снятия с паузы (с опросом БД, если процессов несколько)."""
+        while True:
+            await self._sync_status(job)
+            if job.status != "paused":
+                return
+            try:
+                await asyncio.wait_for(job.resumed.wait(), 5 if MULTIPROCESS else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        """Останавливает задачи рассылок без изменения их статуса (при выключении)."""
+        tasks = [job.task for job in self.jobs.values() if job.task and not job.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _save(self, job: BroadcastJob):
+        await storage.execute(
+            SQL_BROADCAST_SAVE,
+            (job.status, job.cursor, job.sent, job.blocked, job.failed, job.job_id),
+            op="broadcast_save"
+        )
+
+    async def _run(self, job: BroadcastJob):
+        try:
+            async for chunk in job.audience.chunks(job.cursor, self.chunk_size):
+                await self._wait_resumed(job)
+                if job.status != "running":
+                    break
+                recipients = iter(chunk)
+                job.pacer = self._pacer(job)
+                await asyncio.gather(*(self._worker(job, recipients) for _ in range(self.workers)))
+                job.cursor = chunk[-1]
+                # Статус не перезаписываем: его мог поменять другой процесс
+                await storage.execute(
+                    SQL_BROADCAST_PROGRESS, (job.cursor, job.sent, job.blocked, job.failed, job.job_id),
+                    op="broadcast_progress"
+                )
+            if job.status == "running":
+                job.status = "done"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Рассылка #{job.job_id} остановлена из-за ошибки: {e}")
+            job.status = "failed"
+        await self._save(job)
+        self.jobs.pop(job.job_id, None)
+        await self._report(job)
+
+    @staticmethod
+    def _pacer(job: BroadcastJob) -> TokenBucket | None:
+        """Темп, при котором оставшиеся получатели уложатся в окно рассылки.
+
+        Пересчитывается на каждой порции, поэтому пауза, перезапуск или
+        изменившаяся аудитория не сбивают время окончания.
+        """
+        if not job.finish_at:
+            return None
+        left = job.finish_at - time.time()
+        if left <= 0:
+            return None
+        return TokenBucket(max(job.total - job.done, 1) / left, 1)
+
+    async def _worker(self, job: BroadcastJob, recipients):
+        SEND_LANE.set("broadcast")
+        for user_id in recipients:
+            await job.resumed.wait()
+            if job.status == "cancelled":
+                return
+            if job.pacer:
+                await job.pacer.acquire()
+            await self._send(job, user_id)
+
+    async def _send(self, job: BroadcastJob, user_id: int):
+        # retry_after обрабатывает OutboundScheduler, сюда доходят только окончательные ошибки
+        try:
+            if job.input_media:
+                await bot.send_media_group(user_id, job.input_media)
+            elif job.media:
+                item = job.media[0]
+                await getattr(bot, f"send_{item['type']}")(
+                    user_id, item["media"], caption=item.get("caption"), parse_mode="Markdown"
+                )
+            elif job.text is not None:
+                await bot.send_message(user_id, job.text)
+            else:
+                await bot.copy_message(
+                    chat_id=user_id,
+                    from_chat_id=job.from_chat_id,
+                    message_id=job.message_id,
+                    caption=job.caption,
+                    parse_mode="Markdown"
+                )
+            job.sent += 1
+            metrics.inc("bot_broadcast_messages_total", result="sent")
+        except TelegramForbiddenError:
+            await db_set_user_blocked(user_id, True)
+            job.blocked += 1
+            metrics.inc("bot_broadcast_messages_total", result="blocked")
+        except Exception as e:
+            logging.error(f"Ошибка при рассылке пользователю {user_id}: {e}")
+            job.failed += 1
+            metrics.inc("bot_broadcast_messages_total", result="failed")
+
+    async def _report(self, job: BroadcastJob):
+        titles = {"done": "✅ **Рассылка завершена!**", "cancelled": "⛔️ **Рассылка отменена.**"}
+        try:
+            await bot.send_message(
+                job.owner_id,
+                f"{titles.get(job.status, '❗️ **Рассылка прервана из-за ошибки.**')} (#{job.job_id})\n"
+                f"Отправлено успешно: **{job.sent}**\n"
+                f"Новые блокировки (пользователь удалил бота): **{job.blocked}**\n"
+                f"Ошибки: **{job.failed}**"
+            )
+        except Exception as e:
+            logging.error(f"Не удалось отправить отчёт о рассылке #{job.job_id}: {e}")
 
-# 1. URL вашего хостинга (ТОЛЬКО ДОМЕН)
-# Используем адрес Render. Если домен изменится, замените "snowbot-o88c.onrender.com"
-RENDER_DOMAIN = "snowbot-o88c.onrender.com" 
-WEBHOOK_HOST = os.environ.get("RENDER_EXTERNAL_HOSTNAME", RENDER_DOMAIN) 
 
-# 2. URL, по которому Telegram будет отправлять обновления
-WEBHOOK_PATH = f'/webhook/{API_TOKEN}' 
-# 3. Полный URL для установки вебхука
-WEBHOOK_URL = f"https://{WEBHOOK_HOST}{WEBHOOK_PATH}" 
-# 4. Порт, который будет слушать веб-сервер (Render дает его через переменную PORT)
-WEB_SERVER_PORT = int(os.environ.get("PORT", 8080))
+broadcaster = BroadcastEngine(BROADCAST_WORKERS)
 
-# 5. Впишите сюда ID всех владельцев
-BOT_OWNERS = {
-    123456789: "Основной Владелец",  # <--- ЗАМЕНИТЕ ЭТОТ ID
-    987654321: "Второстепенный Программист" # <--- ЗАМЕНИТЕ ЭТОТ ID
-}
 
-# Глобальные переменные
-ADMINS_DB = {}
-USER_CHAT_MAP = {}
+class BroadcastScheduler:
+    """Отложенные рассылки: одна задача-таймер на все.
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+    Ожидающие рассылки лежат в куче (start_at, job_id), задача спит до
+    ближайшей и просыпается раньше, если добавили более раннюю. Тысяча
+    отложенных рассылок - это тысяча пар в куче, а не тысяча спящих задач.
+    Рассылку запускает тот процесс, который первым переведёт её в БД из
+    scheduled в running, так что куча может быть в каждом процессе.
+    """
 
-# Инициализация бота и диспетчера
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
-USER_ID_PATTERN = re.compile(r"\(ID: (\d+)\)")
+    # Сон не дольше этого: переход часов не отложит рассылку надолго
+    MAX_SLEEP = 60
+
+    def __init__(self):
+        self._heap: list[tuple[float, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def add(self, start_at: float, job_id: int):
+        heapq.heappush(self._heap, (start_at, job_id))
+        self._wakeup.set()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    async def start(self):
+        """Загружает отложенные рассылки из БД и запускает таймер."""
+        self._heap = list(await storage.fetchall(
+            "SELECT start_at, job_id FROM broadcasts WHERE status = 'scheduled'",
+            op="schedule_load"
+        ))
+        heapq.heapify(self._heap)
+        if self._heap:
+            logging.info(f"Отложенных рассылок: {len(self._heap)}")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._heap[0][0] - time.time() if self._heap else self.MAX_SLEEP
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(delay, self.MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, job_id = heapq.heappop(self._heap)
+            try:
+                await broadcaster.start_scheduled(job_id)
+            except Exception as e:
+                logging.error(f"Не удалось запустить отложенную рассылку #{job_id}: {e}")
+
+
+broadcast_scheduler = BroadcastScheduler()
 
 
 # --- ================================== ---
-# ---       БЛОК: БАЗА ДАННЫХ (SQLITE)   ---
+# ---      БЛОК: ЗАЩИТА ОТ ФЛУДА         ---
 # --- ================================== ---
 
-def db_init():
-    """Инициализирует базу данных"""
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                is_banned INTEGER DEFAULT 0,
-                is_blocked_bot INTEGER DEFAULT 0
-            )
-        """)
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS admins (
-                admin_id INTEGER PRIMARY KEY,
-                admin_name TEXT
-            )
-        """)
-        db.commit()
+class FloodControl(BaseMiddleware):
+    """Ограничение частоты сообщений и нажатий от одного пользователя.
 
-async def db_add_user(user_id: int):
-    """Добавляет пользователя в БД при /start"""
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute(
-            "INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,)
-        )
-        cursor.execute(
-            "UPDATE users SET is_blocked_bot = 0 WHERE user_id = ?", (user_id,)
-        )
-        db.commit()
+    Token bucket в форме GCRA: на пользователя хранится одно число - момент,
+    к которому его ведро снова наполнится. Пользователь с полным ведром
+    ничем не отличается от нового, поэтому такие записи фоновая задача
+    (sweep) выбрасывает, и память растёт только с числом активных прямо сейчас.
+    Превысивший лимит получает временный мьют: его обновления отбрасываются
+    до обращения к БД. Админы и владельцы не ограничиваются. Альбом Telegram
+    присылает отдельным сообщением на каждую часть, а списывается он как
+    одно сообщение.
+    """
 
-async def db_ban_user(user_id: int, status: bool):
-    """Блокирует или разблокирует пользователя (админом)"""
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute(
-            "UPDATE users SET is_banned = ? WHERE user_id = ?", (1 if status else 0, user_id)
-        )
-        db.commit()
+    def __init__(self, rate: float, burst: int, mute: float):
+        self.interval = 1 / rate
+        # Сколько "вперёд" может уйти ведро: burst сообщений подряд проходят
+        self.tolerance = (burst - 1) * self.interval
+        self.mute = mute
+        self._full_at: dict[int, float] = {}
+        self._muted: dict[int, float] = {}
+        # user_id -> media_group_id последнего альбома, за который уже списан токен
+        self._groups: dict[int, str] = {}
 
-async def db_is_user_banned(user_id: int) -> bool:
-    """Проверяет, забанен ли юзер админом"""
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result[0] == 1 if result else False
+    def hit(self, user_id: int, now: float, media_group_id: str | None = None) -> str:
+        """"ok" - пропустить, "mute" - только что замьючен, "drop" - уже в мьюте."""
+        muted_until = self._muted.get(user_id)
+        if muted_until is not None:
+            if now < muted_until:
+                return "drop"
+            del self._muted[user_id]
+        if media_group_id is not None and self._groups.get(user_id) == media_group_id:
+            # Следующая часть альбома, за который токен уже списан
+            return "ok"
+        full_at = max(self._full_at.get(user_id, now), now)
+        if full_at - now > self.tolerance:
+            self._muted[user_id] = now + self.mute
+            self._full_at.pop(user_id, None)
+            self._groups.pop(user_id, None)
+            return "mute"
+        self._full_at[user_id] = full_at + self.interval
+        if media_group_id is not None:
+            self._groups[user_id] = media_group_id
+        return "ok"
 
-async def db_set_user_blocked(user_id: int, status: bool):
-    """Помечает, что юзер заблокировал бота (при ошибке отправки)"""
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute(
-            "UPDATE users SET is_blocked_bot = ? WHERE user_id = ?", (1 if status else 0, user_id)
-        )
-        db.commit()
+    async def sweep(self):
+        """Удаляет на месте полные вёдра и истёкшие мьюты."""
+        now = time.monotonic()
+        for user_id in [user_id for user_id, at in self._full_at.items() if at <= now]:
+            del self._full_at[user_id]
+            self._groups.pop(user_id, None)
+        for user_id in [user_id for user_id, until in self._muted.items() if until <= now]:
+            del self._muted[user_id]
 
-async def db_get_stats():
-    """Получает статистику из БД"""
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT COUNT(user_id) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(user_id) FROM users WHERE is_banned = 1")
-        banned_by_admin = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(user_id) FROM users WHERE is_blocked_bot = 1")
-        blocked_bot = cursor.fetchone()[0]
-        
-        return {
-            "total": total_users,
-            "banned": banned_by_admin,
-            "blocked": blocked_bot
-        }
+    def tracked(self) -> int:
+        return len(self._full_at) + len(self._muted)
 
-async def db_load_admins():
-    """Загружает админов из БД в кэш ADMINS_DB"""
-    global ADMINS_DB
-    ADMINS_DB = {}
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT admin_id, admin_name FROM admins")
-        rows = cursor.fetchall()
-        for row in rows:
-            ADMINS_DB[row[0]] = row[1]
-    logging.info(f"Загружено админов: {len(ADMINS_DB)}")
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.id in ADMINS_DB or user.id in BOT_OWNERS:
+            return await handler(event, data)
+        verdict = self.hit(user.id, time.monotonic(), getattr(event, "media_group_id", None))
+        if verdict == "ok":
+            return await handler(event, data)
+        metrics.inc("bot_flood_dropped_total")
+        warning = f"⏳ Слишком много сообщений. Подождите {self.mute:.0f} с."
+        if verdict == "mute":
+            logging.info(f"Пользователь {user.id} превысил лимит сообщений, мьют на {self.mute:.0f} с")
+        try:
+            if isinstance(event, CallbackQuery):
+                # Без ответа кнопка крутит индикатор загрузки, пока клиент не сдастся
+                await event.answer(warning if verdict == "mute" else None)
+            elif verdict == "mute":
+                await event.answer(warning)
+        except Exception as e:
+            logging.error(f"Не удалось предупредить пользователя {user.id} о флуде: {e}")
+        return None
 
-async def db_add_admin(admin_id: int, admin_name: str):
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute("INSERT OR REPLACE INTO admins (admin_id, admin_name) VALUES (?, ?)", (admin_id, admin_name))
-        db.commit()
-    await db_load_admins() # Обновляем кэш
 
-async def db_del_admin(admin_id: int):
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute("DELETE FROM admins WHERE admin_id = ?", (admin_id,))
-        db.commit()
-    await db_load_admins() # Обновляем кэш
+flood_control = FloodControl(FLOOD_RATE, FLOOD_BURST, FLOOD_MUTE)
+# Outer middleware срабатывает до фильтров и хэндлеров, то есть до проверки бана в БД
+dp.message.outer_middleware(flood_control)
+dp.callback_query.outer_middleware(flood_control)
+metrics.counter("bot_flood_dropped_total", "Обновления, отброшенные защитой от флуда")
+metrics.gauge("bot_flood_tracked_users", "Пользователи с неполным ведром или в мьюте", flood_control.tracked)
 
 
 # --- ================================== ---
@@ -175,20 +3051,29 @@ in_chat_kb = ReplyKeyboardMarkup(
     keyboard=[[KeyboardButton(text="Поменять админа")]], resize_keyboard=True
 )
 
+# (версия ADMINS_DB, клавиатура) - клавиатура собирается заново только после изменения админов
+_admin_kb_cache: tuple[int, InlineKeyboardMarkup] | None = None
+
 def get_admin_inline_kb():
     """Генерирует инлайн-клавиатуру выбора админа из кэша ADMINS_DB"""
+    global _admin_kb_cache
+    if _admin_kb_cache and _admin_kb_cache[0] == ADMINS_DB.version:
+        return _admin_kb_cache[1]
+
     builder = InlineKeyboardBuilder()
     if not ADMINS_DB:
         builder.add(InlineKeyboardButton(text="Нет доступных админов", callback_data="no_admins"))
-        return builder.as_markup()
-        
-    for admin_id, admin_name in ADMINS_DB.items():
-        builder.add(InlineKeyboardButton(
-            text=admin_name,
-            callback_data=f"select_admin_{admin_id}"
-        ))
-    builder.adjust(1)
-    return builder.as_markup()
+    else:
+        if AUTO_ASSIGN:
+            builder.add(InlineKeyboardButton(text="⚡ Любой свободный админ", callback_data="select_admin_any"))
+        for admin_id, admin_name in ADMINS_DB.items():
+            builder.add(InlineKeyboardButton(
+                text=admin_name,
+                callback_data=f"select_admin_{admin_id}"
+            ))
+        builder.adjust(1)
+    _admin_kb_cache = (ADMINS_DB.version, builder.as_markup())
+    return _admin_kb_cache[1]
 
 
 # --- ================================== ---
@@ -219,68 +3104,153 @@ async def owner_del_admin(message: Message):
         await message.reply(f"Ошибка: {e}\nФормат: /del_admin <ID>")
 
 
+def broadcast_reply(job: BroadcastJob, what: str = "") -> str:
+    """Ответ владельцу на запуск рассылки."""
+    if job.status == "scheduled":
+        start = job.when(job.start_at)
+        if SCHEDULE_TZ is not timezone.utc:
+            # Второй раз по UTC: видно, как сервер понял время
+            start += f" ({time.strftime('%d.%m %H:%M', time.gmtime(job.start_at))} UTC)"
+        text = f"Рассылка{what} #{job.job_id} запланирована на {start}, сейчас это **{job.total}** пользователей"
+    else:
+        text = f"Начинаю рассылку{what} #{job.job_id} **{job.total}** пользователям"
+    if job.finish_at:
+        text += f" с отправкой до {job.when(job.finish_at)}"
+    return (f"{text} ({job.audience.describe()}). Отчёт придёт по завершении.\n"
+            f"Прогресс: /broadcasts, пауза: /bc_pause {job.job_id}, отмена: /bc_cancel {job.job_id}")
+
+def broadcast_usage() -> str:
+    options = "\n".join(f"`{key}=N` - {hint}" for key, hint in Audience.OPTIONS.items())
+    timing = "\n".join(f"`{key}=...` - {hint}" for key, hint in BroadcastSchedule.OPTIONS.items())
+    return ("Введите сообщение для рассылки в формате:\n`/broadcast Ваш текст здесь`\n\n"
+            "Или ответьте на фото/видео/альбом командой `/broadcast`, "
+            "а файл с сервера разошлите командой `/broadcast_file`.\n\n"
+            f"Перед текстом можно указать сегмент, например `/broadcast seen=7 Текст`:\n{options}\n\n"
+            f"И время, например `/broadcast at=18:00 over=2h Текст`:\n{timing}")
+
 # --- ХЭНДЛЕР ДЛЯ РАССЫЛКИ ТОЛЬКО ТЕКСТА ---
 @dp.message(Command("broadcast"), F.from_user.id.in_(BOT_OWNERS.keys()))
 async def start_broadcast(message: Message):
     """Рассылка сообщения всем активным пользователям (только для ВЛАДЕЛЬЦЕВ)."""
     
-    # Игнорируем, если это ответ на медиа (им займется start_broadcast_media)
-    if message.reply_to_message and (message.reply_to_message.photo or message.reply_to_message.video):
-        return 
-        
-    if not message.text or len(message.text.split(maxsplit=1)) < 2:
-        await message.reply("Введите сообщение для рассылки в формате:\n`/broadcast Ваш текст здесь`\n\n"
-                            "Или ответьте на фото/видео командой `/broadcast`.")
+    # Команда в подписи к медиа или ответ на медиа - это рассылки альбома или
+    # медиа (хэндлеры ниже). Command смотрит и в подпись, поэтому пропускаем явно
+    reply = message.reply_to_message
+    if message.text is None or (reply and (reply.photo or reply.video or reply.media_group_id)):
+        raise SkipHandler
+
+    try:
+        audience, schedule, broadcast_text = parse_broadcast_options(
+            message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
+        )
+    except ValueError as e:
+        await message.reply(f"Ошибка: {e}\n\n{broadcast_usage()}")
+        return
+    if not broadcast_text:
+        await message.reply(broadcast_usage())
         return
-        
-    broadcast_text = message.text.split(maxsplit=1)[1]
     
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE is_blocked_bot = 0 AND is_banned = 0")
-        active_users = [row[0] for row in cursor.fetchall()]
-
-    if not active_users:
+    job = await broadcaster.create(message.from_user.id, audience, text=broadcast_text, schedule=schedule)
+    if job is None:
         await message.reply("На данный момент нет активных пользователей для рассылки.")
         return
-    
-    sent_count = 0
-    blocked_count = 0
-    
-    await message.reply(f"Начинаю рассылку **{len(active_users)}** активным пользователям. Пожалуйста, подождите...")
+    await message.reply(broadcast_reply(job))
 
-    for user_id in active_users:
-        try:
-            await bot.send_message(user_id, broadcast_text)
-            sent_count += 1
-            await asyncio.sleep(0.05) 
-            
-        except TelegramForbiddenError:
-            await db_set_user_blocked(user_id, True)
-            blocked_count += 1
-        except Exception as e:
-            logging.error(f"Ошибка при рассылке пользователю {user_id}: {e}")
-            
-    await message.reply(
-        f"✅ **Рассылка завершена!**\n"
-        f"Отправлено успешно: **{sent_count}**\n"
-        f"Новые блокировки (пользователь удалил бота): **{blocked_count}**"
+# --- ХЭНДЛЕР ДЛЯ РАССЫЛКИ АЛЬБОМА ---
+@dp.message(
+    F.from_user.id.in_(BOT_OWNERS.keys()),
+    # Альбом с командой в подписи одной из частей или ответ на альбом командой
+    or_f(
+        F.media_group_id & F.caption.startswith("/broadcast"),
+        and_f(Command("broadcast"), F.reply_to_message.media_group_id)
     )
+)
+async def start_broadcast_album(message: Message):
+    """Рассылка альбома одним sendMediaGroup на получателя."""
+    command = message.text if message.reply_to_message else message.caption
+    rest = command.split(maxsplit=1)[1] if len(command.split()) > 1 else ""
+    try:
+        audience, schedule, caption = parse_broadcast_options(rest)
+    except ValueError as e:
+        await message.reply(f"Ошибка: {e}\n\n{broadcast_usage()}")
+        return
+
+    async def build(media: list[dict]):
+        if not media:
+            await message.reply("Не нашёл частей этого альбома. Отправьте альбом заново с подписью `/broadcast`.")
+            return
+        if not message.reply_to_message:
+            # Команда не должна уйти получателям в подписи
+            for item in media:
+                if (item.get("caption") or "").startswith("/broadcast"):
+                    item["caption"] = None
+        if caption:
+            media[0]["caption"] = caption
+
+        job = await broadcaster.create(message.from_user.id, audience, media=media, schedule=schedule)
+        if job is None:
+            await message.reply("На данный момент нет активных пользователей для рассылки.")
+            return
+        await message.reply(broadcast_reply(job, f" альбома ({len(media)} шт.)"))
+
+    # Остальные части альбома ещё в очереди за этим сообщением - ждать их здесь нельзя
+    media_group_id = message.reply_to_message.media_group_id if message.reply_to_message else message.media_group_id
+    if not album_collector.assemble(media_group_id, build):
+        await message.reply("Этот альбом уже готовится к рассылке.")
+
+@dp.message(F.from_user.id.in_(BOT_OWNERS.keys()), F.media_group_id)
+async def skip_broadcast_album_parts(message: Message):
+    """Остальные части альбома рассылки не пересылаются как обычные сообщения."""
+    if not await album_collector.is_broadcast(message.media_group_id):
+        raise SkipHandler
+
+# --- ХЭНДЛЕР ДЛЯ РАССЫЛКИ ФАЙЛА С ДИСКА ---
+@dp.message(Command("broadcast_file"), F.from_user.id.in_(BOT_OWNERS.keys()))
+async def start_broadcast_file(message: Message):
+    """Рассылка файла из BROADCAST_FILES_DIR: загружается один раз, дальше по file_id."""
+    try:
+        audience, schedule, rest = parse_broadcast_options(
+            message.text.split(maxsplit=1)[1] if len(message.text.split()) > 1 else ""
+        )
+    except ValueError as e:
+        await message.reply(f"Ошибка: {e}\n\n{broadcast_usage()}")
+        return
+    name, _, caption = rest.partition(" ")
+    if not name:
+        files = "\n".join(f"`{file}`" for file in upload_cache.listing()) or "папка пуста"
+        await message.reply("Формат: `/broadcast_file [сегмент] [время] имя_файла подпись`\n\n"
+                            f"Файлы в `{upload_cache.directory}`:\n{files}")
+        return
+
+    try:
+        item = await upload_cache.get(name, message.from_user.id)
+    except (ValueError, OSError) as e:
+        await message.reply(f"Ошибка: {e}")
+        return
+    item["caption"] = caption or None
+
+    job = await broadcaster.create(message.from_user.id, audience, media=[item], schedule=schedule)
+    if job is None:
+        await message.reply("На данный момент нет активных пользователей для рассылки.")
+        return
+    await message.reply(broadcast_reply(job, f" файла `{name}`"))
 
 # --- ХЭНДЛЕР ДЛЯ РАССЫЛКИ ФОТО/ВИДЕО ---
 @dp.message(
     # Общее условие: Доступ только владельцам
     F.from_user.id.in_(BOT_OWNERS.keys()), 
     
-    # Условие 1: Медиа с подписью, начинающейся с /broadcast
-    ((F.photo | F.video) & F.caption.startswith("/broadcast")) | 
-    
-    # Условие 2: Ответ на медиа командой /broadcast (ИСПРАВЛЕНЫ скобки)
-    (
-        F.reply_to_message.media_group_id == None & 
-        F.reply_to_message & 
-        (Command("broadcast")) & 
-        (F.reply_to_message.photo | F.reply_to_message.video)
+    or_f(
+        # Условие 1: Медиа с подписью, начинающейся с /broadcast
+        (F.photo | F.video) & F.caption.startswith("/broadcast"),
+
+        # Условие 2: Ответ на медиа командой /broadcast. Command - не magic-фильтр,
+        # с F его объединяет только and_f
+        and_f(
+            Command("broadcast"),
+            (F.reply_to_message.media_group_id == None)
+            & (F.reply_to_message.photo | F.reply_to_message.video)
+        )
     )
 )
 async def start_broadcast_media(message: Message):
@@ -290,58 +3260,101 @@ async def start_broadcast_media(message: Message):
     source_message = message.reply_to_message if message.reply_to_message else message
 
     caption = None
-    if source_message.caption:
-        # Если команда в подписи, берем текст после нее
-        if source_message.caption.startswith("/broadcast"):
-             caption = source_message.caption.split(maxsplit=1)[1] if len(source_message.caption.split()) > 1 else None
-        else:
-             caption = source_message.caption
-    
-    # Если команда - это ответ, берем подпись из текста команды
-    if message.text and len(message.text.split()) > 1:
-        caption = message.text.split(maxsplit=1)[1]
+    audience, schedule = Audience(), BroadcastSchedule()
+    try:
+        if source_message.caption:
+            # Если команда в подписи, берем текст после нее (и сегмент, если указан)
+            if source_message.caption.startswith("/broadcast"):
+                 rest = source_message.caption.split(maxsplit=1)[1] if len(source_message.caption.split()) > 1 else ""
+                 audience, schedule, caption = parse_broadcast_options(rest)
+                 caption = caption or None
+            else:
+                 caption = source_message.caption
 
-    # 2. Получаем список активных пользователей
-    with sqlite3.connect('livegram.db') as db:
-        cursor = db.cursor()
-        cursor.execute("SELECT user_id FROM users WHERE is_blocked_bot = 0 AND is_banned = 0")
-        active_users = [row[0] for row in cursor.fetchall()]
+        # Если команда - это ответ, берем подпись (и сегмент) из текста команды
+        if message.text and len(message.text.split()) > 1:
+            audience, schedule, text_caption = parse_broadcast_options(message.text.split(maxsplit=1)[1])
+            caption = text_caption or caption
+    except ValueError as e:
+        await message.reply(f"Ошибка: {e}\n\n{broadcast_usage()}")
+        return
 
-    if not active_users:
+    # 2. Запускаем рассылку: отчет придет владельцу по завершении
+    job = await broadcaster.create(
+        message.from_user.id,
+        audience,
+        from_chat_id=source_message.chat.id,
+        message_id=source_message.message_id,
+        caption=caption,
+        schedule=schedule
+    )
+    # 3. Никого не нашлось - рассылка не создана
+    if job is None:
         await message.reply("На данный момент нет активных пользователей для рассылки.")
         return
-    
-    sent_count = 0
-    blocked_count = 0
-    
-    await message.reply(f"Начинаю рассылку медиа **{len(active_users)}** активным пользователям. Пожалуйста, подождите...")
+    await message.reply(broadcast_reply(job, " медиа"))
+
+@dp.message(Command("broadcasts"), F.from_user.id.in_(BOT_OWNERS.keys()))
+async def owner_broadcasts_status(message: Message):
+    """Прогресс активных рассылок."""
+    jobs = await broadcaster.active_jobs()
+    if not jobs:
+        await message.reply("Активных рассылок нет.")
+        return
+    await message.reply("\n".join(job.progress_text() for job in jobs))
+
+@dp.message(Command("bc_pause", "bc_resume", "bc_cancel"), F.from_user.id.in_(BOT_OWNERS.keys()))
+async def owner_broadcast_control(message: Message):
+    """Пауза, продолжение и отмена рассылки по её номеру."""
+    try:
+        command, job_id = message.text.split()
+        actions = {
+            "/bc_pause": broadcaster.pause,
+            "/bc_resume": broadcaster.unpause,
+            "/bc_cancel": broadcaster.cancel,
+        }
+        job = await actions[command.split("@")[0]](int(job_id.lstrip("#")))
+        if job is None:
+            await message.reply(f"Рассылка #{job_id} не найдена или уже завершена.")
+            return
+        await message.reply(job.progress_text())
+    except Exception as e:
+        await message.reply(f"Ошибка: {e}\nФормат: /bc_pause <номер>, /bc_resume <номер>, /bc_cancel <номер>")
+
+@dp.message(Command("profile"), F.from_user.id.in_(BOT_OWNERS.keys()))
+async def owner_profile(message: Message):
+    """Снимает профиль процесса за N секунд и присылает его файлом."""
+    try:
+        _, seconds = message.text.split()
+        seconds = int(seconds)
+        if not 1 <= seconds <= 300:
+            raise ValueError("от 1 до 300 секунд")
+    except Exception as e:
+        await message.reply(f"Ошибка: {e}\nФормат: /profile <секунд>")
+        return
+    if profiler.running:
+        await message.reply("Профилирование уже идёт.")
+        return
+    await message.reply(f"🔬 Профилирую процесс {WORKER_ID} {seconds} с...")
 
-    # 3. Отправляем фото/видео каждому пользователю
-    for user_id in active_users:
+    async def run():
         try:
-            await source_message.copy_to(
-                chat_id=user_id, 
-                caption=caption,
-                parse_mode="Markdown"
+            stacks, samples = await profiler.profile(seconds)
+            await bot.send_document(
+                message.chat.id,
+                BufferedInputFile(stacks.encode(), filename=f"profile-{int(time.time())}.txt"),
+                caption=f"Профиль за {seconds} с, снимков: {samples} (collapsed stacks для flamegraph.pl/speedscope)"
             )
-            sent_count += 1
-            await asyncio.sleep(0.05) 
-            
-        except TelegramForbiddenError:
-            await db_set_user_blocked(user_id, True)
-            blocked_count += 1
         except Exception as e:
-            logging.error(f"Ошибка при рассылке медиа пользователю {user_id}: {e}")
-            
-    # 4. Отчет о рассылке
-    await message.reply(
-        f"✅ **Рассылка медиа завершена!**\n"
-        f"Отправлено успешно: **{sent_count}**\n"
-        f"Новые блокировки: **{blocked_count}**"
-    )
+            logging.error(f"Не удалось снять профиль: {e}")
+
+    # Не держим очередь обновлений этого чата всё время профилирования
+    task = asyncio.create_task(run())
+    BACKGROUND_TASKS.append(task)
+    task.add_done_callback(BACKGROUND_TASKS.remove)
 
 # Команды для ВСЕХ АДМИНОВ (включая владельцев)
-@dp.message(Command("ban"), F.from_user.id.in_(ADMINS_DB.keys()))
+@dp.message(Command("ban"), F.from_user.id.in_(ADMINS_DB))
 async def admin_ban_user(message: Message):
     try:
         _, user_id = message.text.split()
@@ -350,7 +3363,7 @@ async def admin_ban_user(message: Message):
     except Exception as e:
         await message.reply(f"Ошибка: {e}\nФормат: /ban <ID>")
 
-@dp.message(Command("unban"), F.from_user.id.in_(ADMINS_DB.keys()))
+@dp.message(Command("unban"), F.from_user.id.in_(ADMINS_DB))
 async def admin_unban_user(message: Message):
     try:
         _, user_id = message.text.split()
@@ -359,18 +3372,107 @@ async def admin_unban_user(message: Message):
     except Exception as e:
         await message.reply(f"Ошибка: {e}\nФормат: /unban <ID>")
 
-@dp.message(Command("stats"), F.from_user.id.in_(ADMINS_DB.keys()))
+@dp.message(Command("stats"), F.from_user.id.in_(ADMINS_DB))
 async def admin_show_stats(message: Message):
     stats = await db_get_stats()
+    daily = await db_get_daily_stats()
+    cache_stats = user_cache.stats()
+    journal_stats = user_journal.stats()
+    load = "\n".join(
+        f"{ADMINS_DB.get(admin_id, admin_id)}: диалогов {open_count}, сообщений за час {recent}"
+        for admin_id, open_count, recent in admin_load.stats()
+    ) or "нет админов"
+    lanes = "\n".join(
+        f"{lane}: отправлено {info['sent']}, в очереди {info['queued']}, "
+        f"ожидание ср. {info['avg_wait'] * 1000:.0f} мс, макс. {info['max_wait'] * 1000:.0f} мс"
+        for lane, info in outbound.stats().items()
+    )
+    trend = "\n".join(
+        f"{day}: +{values.get('new_users', 0)} новых, {values.get('blocks', 0)} блокировок, "
+        f"{values.get('messages', 0)} сообщений"
+        for day, values in daily.items()
+    ) or "нет данных"
     text = (
         f"📊 **Статистика бота**\n\n"
         f"👥 **Всего нажали /start:** {stats['total']}\n"
         f"🚫 **Забанено админами:** {stats['banned']}\n"
-        f"❌ **Заблокировали бота:** {stats['blocked']} (Обновляется при попытке ответа)"
+        f"❌ **Заблокировали бота:** {stats['blocked']} (Обновляется при попытке ответа)\n\n"
+        f"🧠 **Кэш статусов:** {cache_stats['memory_bytes'] / 1024:.1f} КБ, "
+        f"проверок бана через БД: {cache_stats['db_reads']}\n"
+        f"💾 **Журнал записи:** {journal_stats['flushes']} сбросов, "
+        f"среднее {journal_stats['avg_latency_ms']:.1f} мс, макс. {journal_stats['max_latency_ms']:.1f} мс\n\n"
+        f"📈 **За 7 дней:**\n{trend}\n\n"
+        f"📤 **Очередь отправки:**\n{lanes}\n\n"
+        f"🧑‍💻 **Нагрузка админов:**\n{load}"
     )
     await message.answer(text, parse_mode="Markdown")
 
 
+def archive_page(title: str, rows: list[tuple], next_data: str) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Текст страницы архива и кнопка следующей страницы (если она есть)."""
+    if not rows:
+        return f"{title}\n\nНичего не найдено.", None
+    lines = [title, ""]
+    for _, user_id, admin_id, direction, created_at, text in rows[:MessageArchive.PAGE_SIZE]:
+        admin_name = ADMINS_DB.get(admin_id, str(admin_id))
+        route = f"👤 {user_id} → {admin_name}" if direction == "in" else f"{admin_name} → 👤 {user_id}"
+        if len(text) > 300:
+            text = text[:300] + "…"
+        lines.append(f"[{time.strftime('%d.%m.%y %H:%M', time.localtime(created_at))}] {route}: {text}")
+    keyboard = None
+    if len(rows) > MessageArchive.PAGE_SIZE:
+        before = rows[MessageArchive.PAGE_SIZE - 1][0]
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text="Старше ▶", callback_data=f"{next_data}:{before}")
+        ]])
+    return "\n".join(lines), keyboard
+
+@dp.message(Command("search"), F.from_user.id.in_(ADMINS_DB))
+async def admin_search(message: Message):
+    """Полнотекстовый поиск по архиву переписки."""
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.reply("Формат: /search <слова>")
+        return
+    query = parts[1].replace("\n", " ")
+    try:
+        rows = await archive.search(query)
+    except sqlite3.OperationalError as e:
+        await message.reply(f"Поиск недоступен: {e}")
+        return
+    # Запрос хранится в первой строке ответа: callback_data слишком короткая для него
+    text, keyboard = archive_page(f"🔎 {query}", rows, "arch:s")
+    await message.reply(text, reply_markup=keyboard)
+
+@dp.message(Command("history"), F.from_user.id.in_(ADMINS_DB))
+async def admin_history(message: Message):
+    """Переписка с пользователем, новые сообщения первыми."""
+    try:
+        _, user_id = message.text.split()
+        user_id = int(user_id)
+    except ValueError:
+        await message.reply("Формат: /history <ID пользователя>")
+        return
+    rows = await archive.history(user_id)
+    text, keyboard = archive_page(f"🗂 Переписка с {user_id}", rows, f"arch:h:{user_id}")
+    await message.reply(text, reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("arch:"), F.from_user.id.in_(ADMINS_DB))
+async def admin_archive_page(callback: CallbackQuery):
+    """Следующая страница /search или /history."""
+    *prefix, before = callback.data.split(":")
+    before = int(before)
+    if prefix[1] == "s":
+        title = callback.message.text.split("\n", 1)[0]
+        rows = await archive.search(title.removeprefix("🔎 "), before)
+    else:
+        title = f"🗂 Переписка с {prefix[2]}"
+        rows = await archive.history(int(prefix[2]), before)
+    text, keyboard = archive_page(title, rows, ":".join(prefix))
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
 # --- ================================== ---
 # ---       БЛОК: ХЭНДЛЕРЫ ПОЛЬЗОВАТЕЛЯ  ---
 # --- ================================== ---
@@ -403,8 +3505,7 @@ async def send_welcome(message: Message):
         reply_markup=start_kb
     )
     
-    if user_id in USER_CHAT_MAP:
-        del USER_CHAT_MAP[user_id]
+    await conversations.drop(user_id)
         
 @dp.message(F.text == "Выбор админа")
 async def show_admin_choice(message: Message):
@@ -418,8 +3519,7 @@ async def show_admin_choice(message: Message):
 async def change_admin_handler(message: Message):
     if await check_ban(message): return
     
-    if message.from_user.id in USER_CHAT_MAP:
-        del USER_CHAT_MAP[message.from_user.id]
+    await conversations.drop(message.from_user.id)
         
     await message.answer(
         "Вы завершили диалог. Кому теперь хотите написать?",
@@ -432,14 +3532,20 @@ async def admin_selected(callback: CallbackQuery):
     if await check_ban(callback): return
     
     try:
-        admin_id = int(callback.data.split("_")[-1])
+        if callback.data == "select_admin_any":
+            admin_id = admin_load.least_loaded()
+            if admin_id is None:
+                await callback.answer("Сейчас нет доступных админов.", show_alert=True)
+                return
+        else:
+            admin_id = int(callback.data.split("_")[-1])
         if admin_id not in ADMINS_DB:
             await callback.answer("Ошибка: Админ не найден (возможно, удален).", show_alert=True)
             await callback.message.edit_text("Попробуйте выбрать другого админа:", reply_markup=get_admin_inline_kb())
             return
 
         user_id = callback.from_user.id
-        USER_CHAT_MAP[user_id] = admin_id
+        await conversations.set(user_id, admin_id)
         admin_name = ADMINS_DB[admin_id]
         
         await callback.message.edit_text(
@@ -458,60 +3564,40 @@ async def admin_selected(callback: CallbackQuery):
 
 @dp.message(F.chat.type == "private", 
             ~F.text.startswith('/'), 
-            F.text.not_in({"Выбор админа", "Поменять админа"}))
+            F.text.not_in({"Выбор админа", "Поменять админа"}),
+            # Ответы админов обрабатывает admin_reply_to_user
+            ~(F.from_user.id.in_(ADMINS_DB) & F.reply_to_message))
 async def user_message_to_admin(message: Message):
     if await check_ban(message): return
     
     user_id = message.from_user.id
-    if user_id not in USER_CHAT_MAP:
+    await db_touch_user(user_id)
+    admin_id = await conversations.get(user_id)
+    if admin_id is None:
         await message.answer("Пожалуйста, сначала выберите админа.", reply_markup=start_kb)
         return
         
-    admin_id = USER_CHAT_MAP[user_id]
-    user_info = f"📩 Сообщение от {message.from_user.full_name} (ID: {user_id})"
-    
-    try:
-        # Пересылаем сообщение (работает для всех типов, включая текст)
-        await message.copy_to(
-            chat_id=admin_id,
-            caption=f"{user_info}\n\n{message.caption or message.text or ''}",
-            parse_mode="Markdown" 
-        )
-        
-    except TelegramForbiddenError:
-        logging.warning(f"Админ {admin_id} заблокировал бота. Удаляем его.")
-        await db_del_admin(admin_id)
-        await message.answer("❗️Не удалось отправить. Админ больше недоступен. "
-                             "Попробуйте /start и выберите другого админа.")
-        if user_id in USER_CHAT_MAP:
-            del USER_CHAT_MAP[user_id]
-    except Exception as e:
-        logging.error(f"Ошибка при пересылке админу {admin_id}: {e}")
-        await message.answer("❗️Не удалось отправить. Попробуйте /start и выберите другого админа.")
-        if user_id in USER_CHAT_MAP:
-            del USER_CHAT_MAP[user_id]
+    # Отправка - в очереди админа: воркер обновлений не ждёт его лимита
+    admin_relay.submit(admin_id, message)
 
 # --- ================================== ---
 # ---    БЛОК: ХЭНДЛЕР АДМИНА (ОТВЕТЫ)   ---
 # --- ================================== ---
 
-@dp.message(F.chat.type == "private", F.from_user.id.in_(ADMINS_DB.keys()), F.reply_to_message)
+@dp.message(F.chat.type == "private", F.from_user.id.in_(ADMINS_DB), F.reply_to_message)
 async def admin_reply_to_user(message: Message):
     admin_id = message.from_user.id
     original_message = message.reply_to_message
     
-    # Ищем ID в тексте или подписи оригинального сообщения
-    text_to_parse = original_message.caption or original_message.text
-    if not text_to_parse:
-          await message.reply("⚠️ Ошибка: Не могу найти ID. Отвечайте на сообщения, где виден ID (текст/подпись).")
-          return
-    
-    match = USER_ID_PATTERN.search(text_to_parse)
-    if not match:
-        await message.reply("⚠️ Ошибка: Не могу найти ID. Отвечайте (Reply) на сообщения от бота.")
-        return
-        
-    user_id = int(match.group(1))
+    # Ищем, от какого пользователя пришло сообщение, на которое отвечает админ
+    user_id = await message_links.get(admin_id, original_message.message_id)
+    if user_id is None:
+        # Сообщения, пересланные до появления message_links, несут ID в подписи
+        match = USER_ID_PATTERN.search(original_message.caption or original_message.text or "")
+        if not match:
+            await message.reply("⚠️ Ошибка: Не могу найти пользователя. Отвечайте (Reply) на сообщения от бота.")
+            return
+        user_id = int(match.group(1))
     
     if await db_is_user_banned(user_id):
         await message.reply(f"⚠️ Ошибка: Пользователь {user_id} забанен. Вы не можете ему ответить. "
@@ -527,6 +3613,8 @@ async def admin_reply_to_user(message: Message):
             caption=f"Ответ от {admin_name}:\n\n{message.caption or message.text or ''}",
             parse_mode="Markdown"
         )
+        archive.add(user_id, admin_id, "out", message)
+        stats_count_relayed()
         
     except TelegramForbiddenError:
         logging.info(f"Пользователь {user_id} заблокировал бота. Помечаем в БД.")
@@ -541,6 +3629,162 @@ async def admin_reply_to_user(message: Message):
 # ---       БЛОК: WEBHOOK И ЗАПУСК       ---
 # --- ================================== ---
 
+class InboundFilter:
+    """Дешёвые проверки обновления до валидации моделями aiogram.
+
+    Вебхук подписывается только на типы обновлений, для которых есть
+    хэндлеры (см. configure). Обновления других типов всё же могут прийти -
+    от вебхука, поставленного старой версией бота, - и подтверждаются без
+    разбора моделями и без диспетчера.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.allowed: frozenset[str] = frozenset()
+        self.loads = orjson.loads if orjson else json.loads
+
+    def configure(self, update_types: list[str]):
+        self.allowed = frozenset(update_types)
+
+    @staticmethod
+    def update_type(update) -> str | None:
+        """Тип обновления (message, callback_query, ...) или None, если это не обновление."""
+        if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+            return None
+        for key in update:
+            if key != "update_id":
+                return key
+        return None
+
+
+inbound_filter = InboundFilter(MAX_UPDATE_SIZE)
+
+
+def update_chat_id(update: dict) -> int:
+    """Находит ID чата в сыром обновлении (0, если чата нет)."""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"]
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"]
+    return 0
+
+
+class UpdateQueue:
+    """Ограниченная очередь обновлений с пулом воркеров.
+
+    Каждый воркер читает свою очередь, а чат всегда попадает к одному и тому же
+    воркеру: обновления одного чата обрабатываются по порядку, разных чатов -
+    параллельно. Когда очередь воркера заполнена, put() ждёт (backpressure).
+    """
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queues: list[asyncio.Queue] = []
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        shard_size = max(1, self.maxsize // self.workers)
+        self._queues = [asyncio.Queue(maxsize=shard_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def put(self, update: dict):
+        shard = update_chat_id(update) % self.workers
+        await self._queues[shard].put(update)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await dp.feed_raw_update(bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке обновления: {e}")
+            finally:
+                queue.task_done()
+
+    async def stop(self, timeout: float = 25):
+        """Дожидается обработки уже принятых обновлений и останавливает воркеров."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не дождались обработки {self.depth()} обновлений при остановке")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+
+class UpdateDeduplicator:
+    """Отсекает повторную доставку обновлений Telegram по update_id.
+
+    Последние size ID хранятся в кольце в памяти. Если процессов несколько,
+    повтор может прийти в другой процесс, поэтому ID дополнительно
+    записываются в таблицу processed_updates. Эта запись - сама проверка
+    (INSERT OR IGNORE решает, какой процесс возьмёт обновление), поэтому
+    её не откладывают в пачку: в режиме нескольких процессов каждое
+    обновление стоит одной точечной вставки в потоке БД.
+
+    ID занимается до обработки, чтобы повтор не обработался параллельно.
+    Если обработка упала и Telegram получит ошибку, release() освобождает
+    ID - иначе повторная доставка была бы подтверждена как дубликат и
+    обновление потерялось бы.
+    """
+
+    def __init__(self, size: int, shared: bool):
+        self.shared = shared
+        self._seen: set[int] = set()
+        self._order: deque[int] = deque(maxlen=size)
+
+    async def is_duplicate(self, update_id: int) -> bool:
+        if update_id in self._seen:
+            return True
+        if self.shared:
+            inserted = await storage.execute(
+                "INSERT OR IGNORE INTO processed_updates (update_id, received_at) VALUES (?, ?)",
+                (update_id, time.time()),
+                op="update_claim"
+            )
+            if not inserted:
+                return True
+        # В кольцо - только занятый ID: если вставка упала, повтор должен пройти
+        if len(self._order) == self._order.maxlen:
+            self._seen.discard(self._order[0])
+        self._order.append(update_id)
+        self._seen.add(update_id)
+        return False
+
+    async def release(self, update_id: int):
+        """Снимает отметку с необработанного обновления, чтобы его повтор приняли."""
+        if update_id in self._seen:
+            self._seen.discard(update_id)
+            self._order.remove(update_id)
+        if self.shared:
+            await storage.execute("DELETE FROM processed_updates WHERE update_id = ?", (update_id,), op="update_release")
+
+    async def prune(self):
+        await storage.execute("DELETE FROM processed_updates WHERE received_at < ?", (time.time() - 86400,), op="update_prune")
+
+
+update_dedup = UpdateDeduplicator(UPDATE_DEDUP_SIZE, MULTIPROCESS)
+
+
 # 1. Обработчик входящих вебхуков (ИСПРАВЛЕНО)
 async def webhook_handler(request):
     """Принимает JSON от Telegram и передает его диспетчеру Aiogram."""
@@ -549,49 +3793,285 @@ async def webhook_handler(request):
     # if request.match_info.get('token') != API_TOKEN:
     #     return web.Response(status=403)
     
+    # Лишнее отсекается до валидации моделями: она дороже всего остального пути
+    if (request.content_length or 0) > inbound_filter.max_size:
+        metrics.inc("bot_updates_rejected_total", reason="size")
+        return web.Response(status=413, text='too large')
+    try:
+        update = inbound_filter.loads(await request.read())
+    except web.HTTPRequestEntityTooLarge:
+        # Тело без Content-Length оказалось больше client_max_size
+        metrics.inc("bot_updates_rejected_total", reason="size")
+        return web.Response(status=413, text='too large')
+    except ValueError:
+        update = None
+    update_type = inbound_filter.update_type(update)
+    if update_type is None:
+        metrics.inc("bot_updates_rejected_total", reason="malformed")
+        return web.Response(status=400, text='bad update')
+    if update_type not in inbound_filter.allowed:
+        # Хэндлеров на этот тип нет: подтверждаем, чтобы Telegram не повторял
+        metrics.inc("bot_updates_rejected_total", reason="type")
+        return web.Response(text='ok')
+
+    try:
+        metrics.inc("bot_updates_total")
+        if await update_dedup.is_duplicate(update["update_id"]):
+            # Telegram повторил доставку: уже обработано, просто подтверждаем
+            metrics.inc("bot_updates_duplicate_total")
+            return web.Response(text='ok')
+    except Exception as e:
+        logging.error(f"Ошибка при приёме обновления: {e}")
+        return web.Response(status=500, text='error')
     try:
-        update = await request.json()
-        await dp.feed_raw_update(bot, update)
+        if update_queue.running:
+            # Отвечаем Telegram сразу, обработка идет в воркерах
+            await update_queue.put(update)
+        else:
+            await dp.feed_raw_update(bot, update)
         return web.Response(text='ok')
     except Exception as e:
         logging.error(f"Ошибка при обработке обновления: {e}")
+        # Telegram повторит доставку - повтор не должен считаться дубликатом
+        try:
+            await update_dedup.release(update["update_id"])
+        except Exception as release_error:
+            logging.error(f"Не удалось снять отметку update_id {update['update_id']}: {release_error}")
         return web.Response(status=500, text='error')
 
 
+async def metrics_handler(request):
+    """Метрики процесса для Prometheus."""
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+metrics.gauge("bot_update_queue_depth", "Обновления в очереди обработки", update_queue.depth)
+metrics.gauge("bot_outbound_queue_depth", "Запросы в очереди отправки",
+              lambda: [((("lane", lane),), info["queued"]) for lane, info in outbound.stats().items()])
+metrics.gauge("bot_user_journal_pending", "Несохранённые изменения пользователей",
+              lambda: len(user_journal.pending))
+metrics.gauge("bot_archive_pending", "Сообщения, ещё не записанные в архив", lambda: len(archive.pending))
+metrics.gauge("bot_broadcasts_running", "Рассылки, выполняемые этим процессом", lambda: len(broadcaster.jobs))
+metrics.gauge("bot_broadcasts_scheduled", "Отложенные рассылки в очереди этого процесса", broadcast_scheduler.pending)
+
+
+class StartupState:
+    """Готовность процесса к приёму обновлений и длительность этапов запуска."""
+
+    def __init__(self):
+        self.ready = False
+        self.phases: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def summary(self) -> str:
+        return ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in self.phases.items())
+
+
+startup = StartupState()
+
+
+async def healthz_handler(request):
+    """Процесс жив (liveness)."""
+    return web.Response(text='ok')
+
+
+async def ready_handler(request):
+    """Процесс запущен и принимает обновления (readiness)."""
+    if not startup.ready:
+        return web.Response(status=503, text='starting')
+    return web.Response(text='ready')
+
+
+async def ensure_webhook(info):
+    """Ставит вебхук, только если Telegram знает другой адрес или другие типы обновлений."""
+    allowed_updates = sorted(inbound_filter.allowed)
+    if info.url == WEBHOOK_URL and sorted(info.allowed_updates or []) == allowed_updates:
+        logging.info(f"✅ Вебхук уже установлен на: {WEBHOOK_URL}")
+        return
+    # set_webhook заменяет старый адрес, удалять его заранее не нужно
+    await bot.set_webhook(WEBHOOK_URL, allowed_updates=allowed_updates)
+    logging.info(f"✅ Вебхук установлен на: {WEBHOOK_URL} (обновления: {', '.join(allowed_updates)})")
+
+
 async def on_startup(dispatcher: Dispatcher, bot: Bot):
     """Выполняется при запуске сервера: устанавливает вебхук и инициализирует БД."""
-    
-    db_init()
-    await db_load_admins()
-    
-    # Добавляем ВСЕХ владельцев в админы
-    for owner_id, owner_name in BOT_OWNERS.items():
-        if owner_id not in ADMINS_DB:
-            logging.info(f"Владелец {owner_id} ({owner_name}) не найден в админах. Добавляю...")
-            await db_add_admin(owner_id, owner_name)
-            
-    if WEBHOOK_HOST:
-        # Сначала удаляем, чтобы очистить старый неверный адрес
-        await bot.delete_webhook() 
-        await bot.set_webhook(WEBHOOK_URL)
-        logging.info(f"✅ Вебхук установлен на: {WEBHOOK_URL}")
-    else:
+    primary = WORKER_ID == 0
+    started = time.perf_counter()
+    # Запрос к Telegram идёт параллельно с подготовкой БД
+    webhook_info = asyncio.create_task(bot.get_webhook_info()) if primary and WEBHOOK_HOST else None
+    # Типы обновлений, на которые есть хэндлеры: только их просим у Telegram
+    inbound_filter.configure(dispatcher.resolve_used_update_types())
+
+    with startup.phase("БД"):
+        await db_init()
+    with startup.phase("кэши"):
+        # Позицию журнала изменений запоминаем до загрузки кэшей, чтобы не пропустить события
+        await change_feed.start()
+        await db_load_caches()
+        await conversations.sync_load()
+
+    if primary:
+        # Добавляем ВСЕХ владельцев в админы
+        with startup.phase("владельцы"):
+            await db_seed_owners(BOT_OWNERS)
+
+    # Продолжаем рассылки, прерванные перезапуском
+    with startup.phase("рассылки"):
+        await broadcaster.resume()
+        await broadcast_scheduler.start()
+
+    if primary:
+        BACKGROUND_TASKS.append(asyncio.create_task(
+            run_periodically(600, conversations.prune, "очистка диалогов")
+        ))
+        BACKGROUND_TASKS.append(asyncio.create_task(
+            run_periodically(3600, message_links.prune, "очистка связей сообщений")
+        ))
+        BACKGROUND_TASKS.append(asyncio.create_task(
+            run_periodically(3600, album_collector.prune, "очистка частей альбомов")
+        ))
+        BACKGROUND_TASKS.append(asyncio.create_task(
+            run_periodically(DB_MAINTENANCE_INTERVAL, db_maintenance.tick, "обслуживание БД")
+        ))
+    BACKGROUND_TASKS.append(asyncio.create_task(
+        run_periodically(30, db_flush_relayed, "счётчик сообщений")
+    ))
+    BACKGROUND_TASKS.append(asyncio.create_task(metrics.watch_loop_lag()))
+    BACKGROUND_TASKS.append(asyncio.create_task(
+        run_periodically(60, flood_control.sweep, "очистка защиты от флуда")
+    ))
+    BACKGROUND_TASKS.append(asyncio.create_task(
+        run_periodically(3600, album_collector.forget_old, "очистка известных альбомов")
+    ))
+    BACKGROUND_TASKS.append(asyncio.create_task(
+        run_periodically(60, conversations.sync_load, "нагрузка админов")
+    ))
+    if MULTIPROCESS:
+        BACKGROUND_TASKS.append(asyncio.create_task(
+            run_periodically(0.5, change_feed.poll, "изменения от других процессов")
+        ))
+        if primary:
+            BACKGROUND_TASKS.append(asyncio.create_task(
+                run_periodically(60, change_feed.prune, "очистка журнала изменений")
+            ))
+            BACKGROUND_TASKS.append(asyncio.create_task(
+                run_periodically(3600, update_dedup.prune, "очистка update_id")
+            ))
+
+    user_journal.start()
+    archive.start()
+
+    if WEBHOOK_FAST_ACK:
+        update_queue.start()
+
+    if webhook_info is not None:
+        with startup.phase("вебхук"):
+            await ensure_webhook(await webhook_info)
+    elif primary:
         logging.warning("WEBHOOK_HOST не определен. Вебхук не установлен. Бот будет работать только локально.")
 
+    startup.ready = True
+    logging.info(f"Процесс {WORKER_ID} запущен за {(time.perf_counter() - started) * 1000:.0f} мс: {startup.summary()}")
+
 
 async def on_shutdown(dispatcher: Dispatcher, bot: Bot):
-    """Выполняется при остановке сервера: удаляет вебхук."""
+    """Выполняется при остановке сервера: дорабатывает очередь и закрывает БД.
+
+    Вебхук не удаляется: пока бот перезапускается, Telegram копит обновления
+    у себя и доставит их новому процессу, а при деплое с перекрытием старый
+    процесс не снимет вебхук, уже подтверждённый новым.
+    """
     logging.warning('Отключение...')
-    await bot.delete_webhook()
-    logging.warning('Вебхук удален. Бот остановлен.')
+    startup.ready = False
+    await update_queue.stop()
+    # Хэндлеры отработали - досылаем админам принятое
+    await admin_relay.stop()
+    # Собираемые альбомы создают рассылки - до остановки рассыльщика
+    await album_collector.stop()
+    await broadcast_scheduler.stop()
+    await broadcaster.stop()
+    await outbound.stop()
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
+    await db_flush_relayed()
+    await user_journal.stop()
+    await archive.stop()
+    await storage.close()
+    await bot.session.close()
+    logging.warning('Бот остановлен.')
 
 # Глобальный объект Aiohttp app для запуска
-app = web.Application()
+app = web.Application(client_max_size=MAX_UPDATE_SIZE)
+
+def run_worker(worker_id: int):
+    """Точка входа процесса-воркера: свой event loop и свой сокет на общем порту."""
+    global WORKER_ID
+    WORKER_ID = worker_id
+    logging.info(f"Процесс {worker_id} (pid {os.getpid()}) запущен")
+    web.run_app(
+        app,
+        host='0.0.0.0',
+        port=WEB_SERVER_PORT,
+        reuse_port=True,
+        print=None
+    )
+
+def run_supervisor(workers: int):
+    """Запускает workers процессов на одном порту и перезапускает упавшие."""
+    # Схема создается один раз до запуска воркеров, чтобы они не меняли её наперегонки
+    conn = storage._connect()
+    try:
+        _db_init_sync(conn)
+    finally:
+        conn.close()
+
+    context = multiprocessing.get_context("fork")
+    processes: dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def spawn(worker_id: int):
+        process = context.Process(target=run_worker, args=(worker_id,), name=f"bot-worker-{worker_id}")
+        process.start()
+        processes[worker_id] = process
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for worker_id in range(workers):
+        spawn(worker_id)
+
+    while not stopping:
+        time.sleep(1)
+        for worker_id, process in list(processes.items()):
+            if not process.is_alive() and not stopping:
+                logging.error(f"Процесс {worker_id} завершился (код {process.exitcode}). Перезапускаю...")
+                spawn(worker_id)
+
+    # SIGTERM воркерам: aiohttp штатно выполнит on_shutdown в каждом
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join(30)
 
 def start_webhook_server():
     
     # Регистрируем обработчик вебхуков с токеном в пути
     app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/healthz", healthz_handler)
+    app.router.add_get("/ready", ready_handler)
 
     # Регистрируем функции запуска и остановки
     app.on_startup.append(lambda app: on_startup(dp, bot))
@@ -599,6 +4079,11 @@ def start_webhook_server():
     
     logging.info(f"Сервер слушает порт {WEB_SERVER_PORT}...")
     
+    if MULTIPROCESS:
+        logging.info(f"Запускаю {WEB_WORKERS} процессов (SO_REUSEPORT)")
+        run_supervisor(WEB_WORKERS)
+        return
+
     # Запускаем веб-сервер
     web.run_app(
         app,
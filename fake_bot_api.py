@@ -0,0 +1,157 @@
+"""Локальная замена Telegram Bot API для нагрузочных тестов.
+
+Отвечает на методы Bot API правдоподобными результатами с заданной задержкой
+и долей ошибок, чтобы настройки HTTP-сессии и очереди отправки можно было
+проверять без сети и без реального бота.
+
+Запуск:
+    python fake_bot_api.py [--port 8081] [--latency 0.05] [--error-rate 0.01]
+
+Бот направляется на сервер переменной окружения
+BOT_API_URL=http://127.0.0.1:8081
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """Обработчик запросов к /bot<token>/<method>."""
+
+    # Методы, в ответе на которые есть файл с file_id
+    FILE_METHODS = ("sendphoto", "sendvideo", "senddocument", "sendaudio")
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 blocked_rate: float = 0.0, retry_after_rate: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.blocked_rate = blocked_rate
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.errors = Counter()
+        self.webhook_url = ""
+        self.allowed_updates = None
+        # (chat_id, from_chat_id) -> message_id последней копии: на неё можно ответить
+        self.copies: dict[tuple[int, int], int] = {}
+        self._message_id = 0
+
+    def _message(self, params) -> dict:
+        self._message_id += 1
+        chat_id = params.get("chat_id", "0")
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    def _result(self, method: str, params):
+        if method == "getme":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method == "getwebhookinfo":
+            info = {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+            if self.allowed_updates is not None:
+                info["allowed_updates"] = self.allowed_updates
+            return info
+        if method == "setwebhook":
+            self.webhook_url = params.get("url", "")
+            if "allowed_updates" in params:
+                self.allowed_updates = json.loads(params["allowed_updates"])
+            return True
+        if method == "deletewebhook":
+            self.webhook_url = ""
+            return True
+        if method == "copymessage":
+            self._message_id += 1
+            self.copies[int(params.get("chat_id", 0)), int(params.get("from_chat_id", 0))] = self._message_id
+            return {"message_id": self._message_id}
+        if method == "sendmediagroup":
+            return [self._message(params) for _ in json.loads(params.get("media", "[]"))]
+        if method in self.FILE_METHODS:
+            message = self._message(params)
+            file = {"file_id": f"fake-{method[4:]}-{self._message_id}", "file_unique_id": str(self._message_id)}
+            if method == "sendphoto":
+                message["photo"] = [{**file, "width": 1280, "height": 720}]
+            else:
+                message[method[4:]] = file
+            return message
+        if method.startswith("send") or method.startswith("edit"):
+            return self._message(params)
+        return True
+
+    def _error(self):
+        """Случайная ошибка Telegram или None."""
+        roll = random.random()
+        if roll < self.retry_after_rate:
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.retry_after}",
+                         "parameters": {"retry_after": self.retry_after}}
+        roll -= self.retry_after_rate
+        if roll < self.blocked_rate:
+            return 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        roll -= self.blocked_rate
+        if roll < self.error_rate:
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}
+        return None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        params = await request.post()
+        self.calls[method] += 1
+        delay = self.latency + random.uniform(0, self.jitter) if self.jitter else self.latency
+        if delay:
+            await asyncio.sleep(delay)
+        error = self._error()
+        if error:
+            status, body = error
+            self.errors[status] += 1
+            return web.json_response(body, status=status)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({"calls": dict(self.calls), "errors": dict(self.errors)})
+
+
+def make_app(api: FakeBotAPI) -> web.Application:
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    app.router.add_get("/stats", api.handle_stats)
+    return app
+
+
+async def start_server(api: FakeBotAPI, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+    """Запускает сервер в текущем event loop и возвращает (runner, BOT_API_URL)."""
+    runner = web.AppRunner(make_app(api), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://{host}:{port}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа, сек")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 400")
+    parser.add_argument("--blocked-rate", type=float, default=0.0, help="доля ответов 403 (бот заблокирован)")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, сек")
+    args = parser.parse_args(argv)
+
+    api = FakeBotAPI(args.latency, args.jitter, args.error_rate, args.blocked_rate,
+                     args.retry_after_rate, args.retry_after)
+    web.run_app(make_app(api), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == "__main__":
+    main()